@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+'''
+How much memory upload_bfynn.py uses to read, plan and walk a big .csv
+file, without uploading anything. For each file count, a tree of empty
+files in folders of 1000 is made in a temporary directory, with a .csv
+row with a wildcard entry for each folder, and the peak memory used by
+the planning do_upload does, then walking every file the way staging
+and the upload loop do, is shown. Bytes per file should go down as the file count
+goes up, the peak follows the biggest destination folder, not the
+number of files in the .csv file.
+
+    bench_plan.py [file count ...]
+
+Copyright (c) 2019 by Kendall F. Morris
+kmorris5@usf.edu
+License: GPLv3 or later.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+from upload_bfynn import UploadBlackfynn, RowLedger
+
+PER_FOLDER = 1000
+
+
+def make_tree(root, nfiles):
+    '''
+    nfiles empty files, PER_FOLDER to a folder, and a .csv file that
+    uploads each folder to its own ephys folder. Returns the .csv name.
+    '''
+    rows = []
+    for folder_num in range((nfiles + PER_FOLDER - 1) // PER_FOLDER):
+        folder = os.path.join(root, 'run{:04d}'.format(folder_num))
+        os.makedirs(folder)
+        for file_num in range(min(PER_FOLDER, nfiles - folder_num * PER_FOLDER)):
+            open(os.path.join(folder, 'rec_{:06d}.ns2'.format(file_num)), 'w').close()
+        rows.append(',{},,ephys/run{},{}'.format(folder_num + 1, folder_num,
+                                                 os.path.join(folder, '*.ns2')))
+    csv_name = os.path.join(root, 'bench.csv')
+    with open(csv_name, 'w') as out:
+        out.write('bench_plan.py\n\n\nBench Dataset\nprimary\n')
+        out.write('\n'.join(rows) + '\n')
+    return csv_name
+
+
+def measure(nfiles):
+    '''
+    Returns the number of files walked and the peak memory in bytes.
+    '''
+    root = tempfile.mkdtemp(prefix='bench_plan')
+    try:
+        csv_name = make_tree(root, nfiles)
+        upl = UploadBlackfynn()
+        upl.set_csv(csv_name)
+        upl._dataset = SimpleNamespace(id='N:dataset:bench', name='Bench Dataset')
+        ledger = RowLedger(os.path.join(root, 'rows.json'), csv_name)
+        tracemalloc.start()
+        with upl._expanding():
+            todo, _ = upl._plan_rows(ledger)
+            for unit in upl._iter_units(row for _, row, _ in todo):
+                pass    # what staging goes through
+            walked = 0
+            for _, row, _ in todo:
+                if not row.src_file:
+                    continue
+                dest_name = upl._show_dest(row)
+                for fname in upl._flat_files(upl._make_file_list(row.src_file)):
+                    upl._planned_name(dest_name, [fname])
+                    walked += 1
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return walked, peak
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 50000, 100000, 200000]
+    print('{:>10} {:>10} {:>12} {:>10}'.format('files', 'walked', 'peak KB', 'B/file'))
+    for nfiles in counts:
+        walked, peak = measure(nfiles)
+        print('{:>10} {:>10} {:>12} {:>10.1f}'.format(nfiles, walked, peak // 1024,
+                                                      peak / max(nfiles, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+How long it takes to start upload_bfynn.py, from python -X importtime.
+upload_bfynn is imported in a new python a few times, and the best time
+and the slowest modules it imports are shown. The blackfynn package
+should only be imported when we talk to the site, so this fails if it
+shows up. Each run is added to bench_startup.log in the temporary
+directory, not the source tree, so the startup time can be followed
+from version to version.
+
+    bench_startup.py [runs]
+
+Copyright (c) 2019 by Kendall F. Morris
+kmorris5@usf.edu
+License: GPLv3 or later.
+'''
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOG = os.path.join(tempfile.gettempdir(), 'bench_startup.log')
+SHOW = 10
+
+
+def import_times():
+    '''
+    Import upload_bfynn in a new python. Returns
+    {module: (self microseconds, cumulative microseconds)}.
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import upload_bfynn'],
+                          cwd=HERE, stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, total, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(total))
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    best = None
+    for _ in range(runs):
+        times = import_times()
+        if best is None or times['upload_bfynn'][1] < best['upload_bfynn'][1]:
+            best = times
+    total = best['upload_bfynn'][1]
+    print('import upload_bfynn: {:.1f} ms, best of {}'.format(total / 1000, runs))
+    print('slowest modules, ms by themselves:')
+    for name, (own, _) in sorted(best.items(), key=lambda item: -item[1][0])[:SHOW]:
+        print('  {:>8.1f}  {}'.format(own / 1000, name))
+    sdk = sorted(name for name in best if name.split('.')[0] == 'blackfynn')
+    with open(LOG, 'a') as out:
+        out.write('{}  {:.1f} ms  {} modules{}\n'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), total / 1000, len(best),
+            '  blackfynn imported' if sdk else ''))
+    print('added to {}'.format(LOG))
+    if sdk:
+        sys.exit('The blackfynn package is imported at startup: {}'.format(', '.join(sdk[:5])))
+
+
+if __name__ == '__main__':
+    main()
@@ -33,16 +33,2169 @@ Thu 07 Nov 2019 01:28:14 PM EST
 
 import os
 import csv
+import argparse
+import atexit
+import configparser
 import glob
+import ctypes
+import ctypes.util
+import fnmatch
+import gzip
+import hashlib
+import json
+import re
+import select
+import shutil
+import struct
 import sys
 import time
-from datetime import timedelta
-from blackfynn import Blackfynn, Settings
-from blackfynn.models import Collection
-from blackfynn.api.agent import AgentError
+import threading
+import zipfile
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from stat import S_ISREG
+from xml.etree import ElementTree
 
 __version__ = '1.0.17'
 
+MEGABYTE = 1024 * 1024
+
+# Where we keep things between runs
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.upload_bfynn')
+
+
+class _NotLoaded(Exception):
+    '''
+    Stands in for the blackfynn classes until load_sdk imports them.
+    Nothing is ever one of these.
+    '''
+
+
+# The blackfynn package takes a long time to import, and reading and
+# checking a .csv file, or putting up the gui, does not need it, so it is
+# imported by load_sdk the first time we talk to the site.
+Blackfynn = None
+Collection = AgentError = _NotLoaded
+
+
+def load_sdk():
+    '''
+    Import the blackfynn package, if it is not already.
+    '''
+    global Blackfynn, Collection, AgentError
+    if Blackfynn is None:
+        from blackfynn import Blackfynn as client
+        from blackfynn.models import Collection
+        from blackfynn.api.agent import AgentError
+        Blackfynn = client
+
+
+class UploadCancelled(Exception):
+    '''
+    The user stopped the upload while a transfer was in flight.
+    '''
+
+
+class CancelToken:
+    '''
+    Set when the user stops the upload. Everything that waits, the
+    transfers, the pollers and the retry sleeps, waits on this instead of
+    sleeping, so a Stop takes effect within a second instead of after the
+    current file, or after a two hour wait for a datapackage.
+    '''
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        '''
+        Stop everything.
+        '''
+        self._event.set()
+
+    def reset(self):
+        '''
+        Ready for the next run.
+        '''
+        self._event.clear()
+
+    @property
+    def cancelled(self):
+        '''
+        Has the user stopped the upload?
+        '''
+        return self._event.is_set()
+
+    def sleep(self, seconds):
+        '''
+        Sleep, but wake up right away if cancelled.
+        Returns True if cancelled.
+        '''
+        return self._event.wait(seconds)
+
+
+class Event:
+    '''
+    Something that happened during a run. kind says what, data has the
+    details, and text is the line we show the user, made from fmt and data
+    only when a sink asks for it. Events with no fmt are for programs,
+    not people.
+    '''
+    __slots__ = ('kind', 'time', 'fmt', 'data')
+
+    def __init__(self, kind, fmt, data):
+        self.kind = kind
+        self.time = time.time()
+        self.fmt = fmt
+        self.data = data
+
+    @property
+    def text(self):
+        '''
+        The message for people.
+        '''
+        return self.fmt.format(**self.data) if self.data else self.fmt
+
+    def as_dict(self):
+        '''
+        Everything about the event, for logging.
+        '''
+        out = {'time': self.time, 'kind': self.kind, 'text': self.text}
+        out.update(self.data)
+        return out
+
+
+class EventBus:
+    '''
+    Hands the events from a run to the sinks that want them. A sink is any
+    callable that takes an Event. With no sinks, emit returns right away.
+    '''
+    KINDS = ('row_started', 'collection_created', 'upload_started', 'upload_progress',
+             'package_ready', 'renamed', 'deleted', 'skipped', 'waiting', 'cancelled',
+             'audit', 'preflight', 'checking', 'progress', 'error', 'message', 'summary')
+    # progress lines that replace each other
+    PROGRESS = ('waiting', 'checking', 'progress')
+
+    def __init__(self):
+        self._sinks = ()
+
+    def subscribe(self, sink):
+        '''
+        Start sending events to sink.
+        '''
+        self._sinks = self._sinks + (sink,)
+
+    def unsubscribe(self, sink):
+        '''
+        Stop sending events to sink.
+        '''
+        self._sinks = tuple(have for have in self._sinks if have is not sink)
+
+    def emit(self, kind, fmt='', **data):
+        '''
+        Send an event to the sinks.
+        '''
+        if not self._sinks:
+            return
+        event = Event(kind, fmt, data)
+        for sink in self._sinks:
+            try:
+                sink(event)
+            except Exception:
+                pass    # a broken sink must not stop an upload
+
+
+class ConsoleSink:
+    '''
+    Show events on stdout. Progress lines overwrite each other.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = False
+
+    def __call__(self, event):
+        text = event.text
+        if not text:
+            return
+        with self._lock:
+            if event.kind in EventBus.PROGRESS:
+                sys.stdout.write('\r' + text)
+                self._open = True
+            else:
+                if self._open:
+                    sys.stdout.write('\n')
+                    self._open = False
+                sys.stdout.write(text + '\n')
+            sys.stdout.flush()
+
+
+class JsonlSink:
+    '''
+    Log every event to a file, one json object per line.
+    '''
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._out = open(path, 'a')
+
+    def __call__(self, event):
+        line = json.dumps(event.as_dict(), default=str)
+        with self._lock:
+            if self._out.closed:
+                return
+            self._out.write(line + '\n')
+            self._out.flush()
+
+    def close(self):
+        '''
+        Done logging. Events that come in later, from background threads
+        that are still finishing up, are dropped.
+        '''
+        with self._lock:
+            self._out.close()
+
+
+class BandwidthSchedule:
+    '''
+    An upload bandwidth ceiling that can change with the time of day.
+    The spec is a comma separated list of START-END=MB/s windows plus an
+    optional *=MB/s for the rest of the day, for example:
+
+        20:00-07:00=0, *=10
+
+    means full speed from 8 PM to 7 AM and 10 MB/s the rest of the time.
+    A limit of 0 means no limit. A plain number, such as 10, is a limit
+    that applies all day. An empty spec means no limit at all.
+    Raises ValueError if the spec does not make sense.
+    '''
+    def __init__(self, spec=''):
+        self.spec = spec.strip() if spec else ''
+        self._windows = []   # (start minute, end minute, bytes per second)
+        self._default = 0
+        for part in self.spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '=' not in part:
+                self._default = self._rate(part)
+                continue
+            when, rate = part.split('=', 1)
+            when = when.strip()
+            if when == '*':
+                self._default = self._rate(rate)
+                continue
+            try:
+                start, end = when.split('-')
+            except ValueError:
+                raise ValueError('Bad time window "{}", use HH:MM-HH:MM'.format(when))
+            self._windows.append((self._minute(start), self._minute(end), self._rate(rate)))
+
+    @staticmethod
+    def _rate(text):
+        '''
+        MB/s text to bytes per second.
+        '''
+        try:
+            rate = float(text)
+        except ValueError:
+            raise ValueError('Bad bandwidth "{}", expected MB/s'.format(text.strip()))
+        if rate < 0:
+            raise ValueError('Bandwidth cannot be negative')
+        return int(rate * MEGABYTE)
+
+    @staticmethod
+    def _minute(text):
+        '''
+        HH:MM text to minutes after midnight.
+        '''
+        try:
+            hour, minute = text.strip().split(':')
+            hour, minute = int(hour), int(minute)
+        except ValueError:
+            raise ValueError('Bad time "{}", use HH:MM'.format(text.strip()))
+        if not (0 <= hour <= 24 and 0 <= minute < 60):
+            raise ValueError('Bad time "{}", use HH:MM'.format(text.strip()))
+        return (hour * 60 + minute) % (24 * 60)
+
+    def limit(self, when=None):
+        '''
+        Return the limit in bytes/sec at the time when (a time.struct_time,
+        default now), 0 if there is no limit.
+        '''
+        if not self._windows:
+            return self._default
+        if when is None:
+            when = time.localtime()
+        minute = when.tm_hour * 60 + when.tm_min
+        for start, end, rate in self._windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:          # window wraps around midnight
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self._default
+
+    def describe(self, when=None):
+        '''
+        Human readable version of the limit in effect.
+        '''
+        rate = self.limit(when)
+        if not rate:
+            return 'No limit'
+        return '{:g} MB/s'.format(round(rate / MEGABYTE, 2))
+
+
+class UploadThrottle:
+    '''
+    The SDK owns the network connection, so we can't meter the bytes as
+    they go out. Instead, pace the uploads. After a transfer, work out when
+    it would have finished at the current limit, and hold off the next
+    transfer until then. This keeps the average rate at or under the limit.
+    Nothing is lost by pausing, it only happens between files.
+    '''
+    def __init__(self, schedule=None):
+        self.schedule = schedule if schedule else BandwidthSchedule()
+        self._not_before = 0.0
+
+    def charge(self, nbytes, start, end):
+        '''
+        A transfer of nbytes ran from start to end. Figure out when the
+        next one may start.
+        '''
+        rate = self.schedule.limit()
+        if rate:
+            self._not_before = max(end, start + nbytes / rate)
+        else:
+            self._not_before = 0.0
+
+    def pause_needed(self):
+        '''
+        How many seconds until we can start the next transfer?
+        If the schedule has moved to no limit, we are good to go.
+        '''
+        if not self.schedule.limit():
+            self._not_before = 0.0
+            return 0
+        return max(0, self._not_before - time.time())
+
+
+class RunProgress:
+    '''
+    How far along a whole run is, by bytes. The bytes to send are added up
+    from the files before the uploads start. Sends in flight count as they
+    go, at the current rate, since the SDK does not tell us. The rate is a
+    running average of the finished sends. The time left adds in how long
+    the site has been taking to process each byte we sent, so a run that
+    waits on UNAVAILABLE packages is not shown as nearly done. Safe to read
+    from any thread: the command line shows text() as one status line, the
+    GUI can read status().
+    '''
+    WEIGHT = 0.2    # of each finished send in the running average
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = iter(range(1, sys.maxsize))
+        self.reset()
+
+    def reset(self, total_bytes=0, total_files=0):
+        '''
+        Start over, with this much to send.
+        '''
+        with self._lock:
+            self.total_bytes = total_bytes
+            self.total_files = total_files
+            self.done_bytes = 0
+            self.done_files = 0
+            self.skipped_bytes = 0
+            self.skipped_files = 0
+            self.wait_seconds = 0.0
+            self._active = {}       # key -> [bytes, files, start]
+            self._avg_bytes = 0.0   # the rate is _avg_bytes / _avg_seconds
+            self._avg_seconds = 0.0
+            self._start = time.time()
+
+    def add(self, nbytes, nfiles):
+        '''
+        More to send, a file that showed up in a watched folder.
+        '''
+        with self._lock:
+            self.total_bytes += nbytes
+            self.total_files += nfiles
+
+    def skip(self, nbytes, nfiles):
+        '''
+        Planned files that will not be sent, they were already there.
+        '''
+        with self._lock:
+            self.skipped_bytes += nbytes
+            self.skipped_files += nfiles
+
+    def started(self, nbytes, nfiles):
+        '''
+        A send started. Returns the key to pass to finished.
+        '''
+        with self._lock:
+            key = next(self._keys)
+            self._active[key] = [nbytes, nfiles, time.time()]
+        return key
+
+    def finished(self, key, sent=True):
+        '''
+        A send is over. If it failed or was stopped, its bytes are not
+        going to be sent.
+        '''
+        with self._lock:
+            nbytes, nfiles, start = self._active.pop(key)
+            if not sent:
+                self.skipped_bytes += nbytes
+                self.skipped_files += nfiles
+                return
+            self.done_bytes += nbytes
+            self.done_files += nfiles
+            seconds = max(time.time() - start, 0.001)
+            if self._avg_seconds:
+                self._avg_bytes += self.WEIGHT * (nbytes - self._avg_bytes)
+                self._avg_seconds += self.WEIGHT * (seconds - self._avg_seconds)
+            else:
+                self._avg_bytes, self._avg_seconds = nbytes, seconds
+
+    def waited(self, seconds):
+        '''
+        We waited this long on the site to process a package.
+        '''
+        with self._lock:
+            self.wait_seconds += seconds
+
+    def status(self):
+        '''
+        A dict with percent, done_bytes (with the sends in flight),
+        total_bytes (without the skipped ones), done_files, total_files,
+        rate in bytes per second and eta in seconds, None if we do not know
+        them yet, active sends, queued files not sent yet and elapsed
+        seconds.
+        '''
+        now = time.time()
+        with self._lock:
+            rate = self._avg_bytes / self._avg_seconds if self._avg_seconds else None
+            in_flight = sum(min(nbytes, rate * (now - start)) if rate else 0
+                            for nbytes, _, start in self._active.values())
+            done = self.done_bytes + in_flight
+            total = max(self.total_bytes - self.skipped_bytes, 0)
+            left = max(total - done, 0)
+            eta = None
+            if rate:
+                eta = left / rate
+                if self.done_bytes:
+                    eta += left * self.wait_seconds / self.done_bytes
+            sending = sum(nfiles for _, nfiles, _ in self._active.values())
+            return {'percent': 100.0 * done / total if total else 100.0,
+                    'done_bytes': int(done), 'total_bytes': total,
+                    'done_files': self.done_files, 'total_files': self.total_files,
+                    'rate': rate, 'eta': eta, 'active': len(self._active),
+                    'queued': max(self.total_files - self.done_files - self.skipped_files
+                                  - sending, 0),
+                    'elapsed': now - self._start}
+
+    def text(self, status=None):
+        '''
+        One line for people.
+        '''
+        stat = status or self.status()
+        line = '{:.1f}% of {:.1f} MB, {} of {} files'.format(
+            stat['percent'], stat['total_bytes'] / MEGABYTE, stat['done_files'],
+            stat['total_files'])
+        if stat['rate']:
+            line += ', {:.2f} MB/s'.format(stat['rate'] / MEGABYTE)
+        if stat['eta'] is not None:
+            line += ', about {} left'.format(timedelta(seconds=int(stat['eta'])))
+        return line
+
+
+class ReadyCache:
+    '''
+    Remember which collections we saw in the READY state, and when.
+    A collection only stops being READY when something is written to it,
+    and the only writer during a run is us, so a recent READY can be
+    trusted until we write to the collection. This saves a round trip
+    to the server for most _wait_for_ready calls.
+    '''
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.saved = 0       # round trips we did not have to make
+        self._ready = {}     # collection id -> time we saw it READY
+        self._lock = threading.Lock()
+
+    def is_ready(self, coll_id):
+        '''
+        True if we saw the collection READY less than ttl seconds ago.
+        '''
+        with self._lock:
+            when = self._ready.get(coll_id)
+            if when is not None and time.time() - when < self.ttl:
+                self.saved += 1
+                return True
+            return False
+
+    def mark_ready(self, coll_id):
+        '''
+        The server just told us the collection is READY.
+        '''
+        with self._lock:
+            self._ready[coll_id] = time.time()
+
+    def invalidate(self, coll_id):
+        '''
+        We wrote to the collection, so need to ask again.
+        '''
+        with self._lock:
+            self._ready.pop(coll_id, None)
+
+
+class SingleFlight:
+    '''
+    Make sure a piece of work keyed by key is only done once, no matter how
+    many threads ask for it at the same time. The first caller does the
+    work, the rest wait for it and get the same result. Successful results
+    are remembered, so later callers get them right away. Failures are not
+    remembered, the next caller tries again.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}   # key -> [done event, result, exception]
+        self._results = {}     # key -> result
+
+    def do(self, key, func):
+        '''
+        Return func(), or the result of the call to func for this key that
+        is in flight or already done.
+        '''
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = [threading.Event(), None, None]
+                self._in_flight[key] = call
+        if not leader:
+            call[0].wait()
+        else:
+            try:
+                call[1] = func()
+            except Exception as ex:
+                call[2] = ex
+            with self._lock:
+                del self._in_flight[key]
+                if call[2] is None and call[1] is not None:
+                    self._results[key] = call[1]
+            call[0].set()
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+    def forget(self, key):
+        '''
+        Drop a remembered result.
+        '''
+        with self._lock:
+            self._results.pop(key, None)
+
+
+class CollectionLister:
+    '''
+    List what is in a collection a page at a time, only as the caller asks
+    for more, so a search that finds what it is after early stops there, and
+    a collection with tens of thousands of packages is never all in memory
+    at once. Pages come from GET /packages/{id} with limit and offset. The
+    dataset itself can not be listed that way, so it, and any collection if
+    the site will not page, is listed all at once with collection.items.
+    So is the rest of a collection whose next page brings back nothing new,
+    which is what a site that ignores offset does. Counts the pages fetched
+    and the listings that could not be paged.
+    '''
+    PAGE_SIZE = 100
+    MAX_PAGES = 2000   # more than this and something is wrong, list it all at once
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = 0
+        self.paged = 0
+        self.unpaged = 0
+        self._paging = True
+        self._lock = threading.Lock()
+
+    def children(self, b_fynn, collection, kind=None, fresh=False):
+        '''
+        Yield what is in collection. kind is 'collections' or 'packages' to
+        only get those; the site has no way to do this for us, so each page
+        is filtered as it comes in. A listing the collection object already
+        has is used, unless fresh is True.
+        '''
+        want = {'collections': lambda item: isinstance(item, Collection),
+                'packages': lambda item: not isinstance(item, Collection)}.get(
+                    kind, lambda item: True)
+        for page in self._pages(b_fynn, collection, fresh):
+            for item in page:
+                if want(item):
+                    yield item
+
+    def _pages(self, b_fynn, collection, fresh):
+        '''
+        Yield lists of child objects, one per page.
+        '''
+        if getattr(collection, '_items', None) is not None and not fresh:
+            yield collection.items
+            return
+        seen = set()
+        if self._paging and isinstance(collection, Collection):
+            api = b_fynn._api.packages
+            with self._lock:
+                self.paged += 1
+            offset = 0
+            for _ in range(self.MAX_PAGES):
+                try:
+                    resp = api._get(api._uri('/{id}', id=collection.id),
+                                    params={'limit': self.page_size, 'offset': offset})
+                    kids = resp['children']
+                except Exception:
+                    if not offset:
+                        self._paging = False   # the site will not page, stop trying
+                    break
+                with self._lock:
+                    self.pages += 1
+                page = [api._get_package_from_data(kid) for kid in kids]
+                page = [item for item in page if item.id not in seen]
+                if kids and not page:   # offset ignored, the same page again
+                    self._paging = False
+                    break
+                seen.update(item.id for item in page)
+                yield page
+                if len(kids) < self.page_size:
+                    return
+                if len(kids) > self.page_size:   # limit ignored, that was all of it
+                    self._paging = False
+                    return
+                offset += len(kids)
+        with self._lock:
+            self.unpaged += 1
+        if fresh:
+            collection = b_fynn.get(collection.id)
+        yield [item for item in collection.items if item.id not in seen]
+
+
+class DatasetSnapshot:
+    '''
+    A compact copy of what is in a dataset: the collection tree, and the
+    name, id, state and source file names and sizes of each package.
+    It is saved to disk so the next run starts out knowing what is on the
+    site instead of finding out one collection.items or sources call at a
+    time. take() walks the whole dataset, breadth first, listing each level
+    in parallel. revalidate() brings a loaded snapshot up to date with one
+    GET per collection, and only asks for the sources of packages that are
+    new or have changed state.
+    '''
+    VERSION = 1
+
+    def __init__(self, dataset_id='', dataset_name=''):
+        self.dataset_id = dataset_id
+        self.dataset_name = dataset_name
+        self.taken = 0
+        self.collections = {}   # id -> [name, parent id, marker]
+        self.packages = {}      # id -> [name, parent id, state, [[source, size, checksum], ...]]
+        self._by_coll = {}      # collection id -> {source name: package id}
+        self._kids = {}         # collection id -> set of ids of what is in it
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_path(dataset_id):
+        '''
+        Where we keep the snapshot of a dataset.
+        '''
+        safe = ''.join(c if c.isalnum() or c in '-_' else '_' for c in dataset_id)
+        return os.path.join(STATE_DIR, 'snapshot-' + safe + '.json.gz')
+
+    @staticmethod
+    def _marker(node):
+        '''
+        Modification marker for a collection, if the platform gives us one.
+        '''
+        marker = getattr(node, 'updated_at', None)
+        return str(marker) if marker is not None else ''
+
+    @staticmethod
+    def pkg_sources(pkg):
+        '''
+        [[source file name, size, checksum], ...] for a package.
+        '''
+        try:
+            return [[os.path.basename(src.s3_key), getattr(src, 'size', None),
+                     DatasetSnapshot._checksum(src)] for src in pkg.sources]
+        except Exception:
+            return []
+
+    @staticmethod
+    def _checksum(src):
+        '''
+        The checksum of a source file, if the platform gives one, as
+        [md5 in hex, chunk size]. The chunk size is None for a plain md5,
+        otherwise it is the md5 of the md5s of the chunks. Snapshots from
+        before we kept it have no checksum.
+        '''
+        value = getattr(src, 'checksum', None)
+        if isinstance(value, dict):
+            digest = value.get('checksum') or value.get('hash')
+            return [digest, value.get('chunkSize')] if digest else None
+        if isinstance(value, str) and value:
+            return [value, None]
+        return None
+
+    def add_collection(self, coll_id, name, parent_id, marker=''):
+        '''
+        Record a collection.
+        '''
+        with self._lock:
+            self.collections[coll_id] = [name, parent_id, marker]
+            self._by_coll.setdefault(coll_id, {})
+            self._kids.setdefault(coll_id, set())
+            if parent_id is not None:
+                self._kids.setdefault(parent_id, set()).add(coll_id)
+
+    def add_package(self, pkg_id, name, parent_id, state, sources):
+        '''
+        Record a package and index it by its source file names.
+        '''
+        with self._lock:
+            self._drop_package(pkg_id)
+            self.packages[pkg_id] = [name, parent_id, state, sources]
+            self._kids.setdefault(parent_id, set()).add(pkg_id)
+            names = self._by_coll.setdefault(parent_id, {})
+            for src in sources:
+                names[src[0]] = pkg_id
+
+    def rename_package(self, pkg_id, name):
+        '''
+        We renamed a package.
+        '''
+        with self._lock:
+            if pkg_id in self.packages:
+                self.packages[pkg_id][0] = name
+
+    def _drop_package(self, pkg_id):
+        pkg = self.packages.pop(pkg_id, None)
+        if pkg:
+            self._kids.get(pkg[1], set()).discard(pkg_id)
+            names = self._by_coll.get(pkg[1], {})
+            for src in pkg[3]:
+                if names.get(src[0]) == pkg_id:
+                    del names[src[0]]
+
+    def drop_package(self, pkg_id):
+        '''
+        A package is gone.
+        '''
+        with self._lock:
+            self._drop_package(pkg_id)
+
+    def _drop_collection(self, coll_id):
+        for kid in list(self._kids.get(coll_id, ())):
+            if kid in self.packages:
+                self._drop_package(kid)
+            else:
+                self._drop_collection(kid)
+        coll = self.collections.pop(coll_id, None)
+        if coll:
+            self._kids.get(coll[1], set()).discard(coll_id)
+        self._by_coll.pop(coll_id, None)
+        self._kids.pop(coll_id, None)
+
+    def knows(self, coll_id):
+        '''
+        Is this collection in the snapshot?
+        '''
+        return coll_id in self.collections
+
+    def has_source(self, coll_id, fname):
+        '''
+        Is there a package in the collection with fname as a source?
+        '''
+        return fname in self._by_coll.get(coll_id, {})
+
+    def unsettled(self, coll_id, fname):
+        '''
+        Ids of the packages in the collection that may hold fname but had
+        no sources yet, or were UNAVAILABLE, when we saw them: the ones
+        named fname, or fname without its extension.
+        '''
+        names = (fname, os.path.splitext(fname)[0])
+        return [kid for kid in self.packages_in(coll_id)
+                if self.packages[kid][0] in names
+                and (not self.packages[kid][3] or self.packages[kid][2] == 'UNAVAILABLE')]
+
+    def package_for(self, coll_id, fname):
+        '''
+        Id of the package in the collection with fname as a source, or None.
+        '''
+        return self._by_coll.get(coll_id, {}).get(fname)
+
+    def packages_in(self, coll_id):
+        '''
+        Ids of the packages in a collection.
+        '''
+        return [kid for kid in self._kids.get(coll_id, ()) if kid in self.packages]
+
+    def source_size(self, pkg_id, fname):
+        '''
+        Size of the source file fname of a package, None if not known.
+        '''
+        for src in self.packages.get(pkg_id, ['', '', '', []])[3]:
+            if src[0] == fname:
+                return src[1]
+        return None
+
+    def paths(self):
+        '''
+        {collection path tuple: collection id} for the whole dataset.
+        '''
+        return {self.path_of(coll_id): coll_id for coll_id in self.collections}
+
+    def path_of(self, coll_id):
+        '''
+        Collection path tuple under the dataset.
+        '''
+        path = []
+        while coll_id in self.collections and coll_id != self.dataset_id:
+            name, coll_id, _ = self.collections[coll_id]
+            path.append(name)
+        return tuple(reversed(path))
+
+    def _take_level(self, pool, colls):
+        '''
+        List one level of collections in parallel, record what is in them,
+        and return the collections in the next level down.
+        '''
+        next_level = []
+        pkgs = []
+        for coll, items in zip(colls, pool.map(lambda coll: list(coll.items), colls)):
+            for item in items:
+                if isinstance(item, Collection):
+                    self.add_collection(item.id, item.name, coll.id, self._marker(item))
+                    next_level.append(item)
+                else:
+                    pkgs.append((item, coll.id))
+        for (pkg, parent_id), sources in zip(pkgs, pool.map(lambda pkg: self.pkg_sources(pkg[0]),
+                                                             pkgs)):
+            self.add_package(pkg.id, pkg.name, parent_id, pkg.state, sources)
+        return next_level
+
+    def take(self, dataset, workers=8):
+        '''
+        Walk the whole dataset and record everything in it.
+        '''
+        self.__init__(dataset.id, dataset.name)
+        self.add_collection(dataset.id, dataset.name, None, self._marker(dataset))
+        level = [dataset]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while level:
+                level = self._take_level(pool, level)
+        self.taken = time.time()
+
+    def revalidate(self, b_fynn, workers=8):
+        '''
+        Bring the snapshot up to date. Get each collection again (in
+        parallel), which gives us its marker and a list of what is in it.
+        Collections whose marker and contents match are left alone. New
+        packages, and packages that changed state, get their sources looked
+        up. New collections are walked. Returns the number of collections
+        that had changed.
+        '''
+        changed = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            level = list(self.collections)
+            while level:
+                fresh = list(pool.map(lambda coll_id: self._get(b_fynn, coll_id), level))
+                next_level = []
+                pkgs = []
+                for coll_id, coll in zip(level, fresh):
+                    if coll is None:       # deleted out from under us
+                        with self._lock:
+                            self._drop_collection(coll_id)
+                        changed += 1
+                        continue
+                    found = self._compare(coll, next_level, pkgs)
+                    changed += found
+                level = next_level
+                for (pkg, parent_id), sources in zip(pkgs, pool.map(
+                        lambda pkg: self.pkg_sources(pkg[0]), pkgs)):
+                    self.add_package(pkg.id, pkg.name, parent_id, pkg.state, sources)
+        self.taken = time.time()
+        return changed
+
+    @staticmethod
+    def _get(b_fynn, coll_id):
+        try:
+            return b_fynn.get(coll_id)
+        except Exception:
+            return None
+
+    def _compare(self, coll, next_level, pkgs):
+        '''
+        Compare a freshly fetched collection with what we have. Queue up new
+        collections and new or changed packages. Returns 1 if anything
+        changed, 0 if not.
+        '''
+        marker = self._marker(coll)
+        old = self.collections.get(coll.id)
+        kids = {}
+        for item in coll.items:
+            kids[item.id] = item
+        with self._lock:
+            had = set(self._kids.get(coll.id, ()))
+            if old and old[2] == marker and marker and had == set(kids):
+                same = all(self.packages[key][2] == item.state for key, item in kids.items()
+                           if key in self.packages)
+                if same:
+                    return 0
+            for gone in had - set(kids):
+                if gone in self.packages:
+                    self._drop_package(gone)
+                else:
+                    self._drop_collection(gone)
+        parent_id = old[1] if old else None
+        self.add_collection(coll.id, coll.name, parent_id, marker)
+        for key, item in kids.items():
+            if isinstance(item, Collection):
+                if key not in self.collections:
+                    self.add_collection(key, item.name, coll.id, self._marker(item))
+                    next_level.append(key)
+            elif key not in self.packages or self.packages[key][2] != item.state:
+                pkgs.append((item, coll.id))
+            else:
+                self.packages[key][0] = item.name
+        return 1
+
+    def save(self, path):
+        '''
+        Write the snapshot, compact json, gzipped.
+        '''
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._lock:
+            data = {'version': self.VERSION, 'dataset': [self.dataset_id, self.dataset_name],
+                    'taken': self.taken, 'collections': self.collections,
+                    'packages': self.packages}
+            tmp_name = path + '.tmp'
+            with gzip.open(tmp_name, 'wt') as out:
+                json.dump(data, out, separators=(',', ':'))
+        os.replace(tmp_name, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a snapshot, returns None if it is not there or unreadable.
+        '''
+        try:
+            with gzip.open(path, 'rt') as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != cls.VERSION:
+            return None
+        snap = cls(*data['dataset'])
+        snap.taken = data['taken']
+        for coll_id, (name, parent_id, marker) in data['collections'].items():
+            snap.add_collection(coll_id, name, parent_id, marker)
+        for pkg_id, (name, parent_id, state, sources) in data['packages'].items():
+            snap.add_package(pkg_id, name, parent_id, state, sources)
+        return snap
+
+
+class PackageCache:
+    '''
+    We ask for the same datapackages over and over: after an upload, in each
+    tick of _okay_to_update, again before a rename, and when checking what
+    is already on the site. Keep the ones we got lately. Only packages in a
+    settled state are handed out from the cache, one that is still being
+    processed is always fetched, since its state is what we are waiting on.
+    A fetch that shows a new state replaces the cached one. Our own renames
+    are written through to the cache. It holds at most max_items packages,
+    the least recently used go first, and entries expire after ttl seconds.
+    '''
+    SETTLED = ('READY', 'ERROR')
+
+    def __init__(self, fetch, max_items=1000, ttl=300):
+        self._fetch = fetch
+        self.max_items = max_items
+        self.ttl = ttl
+        self.saved = 0     # GETs we did not have to do
+        self._items = OrderedDict()   # id -> (time, package)
+        self._lock = threading.Lock()
+
+    def get(self, pkg_id):
+        '''
+        Return the package, from the cache if we can.
+        '''
+        with self._lock:
+            entry = self._items.get(pkg_id)
+            if (entry and time.time() - entry[0] < self.ttl and
+                    entry[1].state in self.SETTLED):
+                self._items.move_to_end(pkg_id)
+                self.saved += 1
+                return entry[1]
+        pkg = self._fetch(pkg_id)
+        self.put(pkg)
+        return pkg
+
+    def put(self, pkg):
+        '''
+        Add or replace a package, we have the current version.
+        '''
+        with self._lock:
+            self._items[pkg.id] = (time.time(), pkg)
+            self._items.move_to_end(pkg.id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, pkg_id):
+        '''
+        Forget a package.
+        '''
+        with self._lock:
+            self._items.pop(pkg_id, None)
+
+
+class PendingUploads:
+    '''
+    Files uploaded through the agent that we have not found on the site
+    yet. The agent tells us nothing about what it uploaded, so we have to
+    find the new datapackage by its source file names before we can rename
+    it. There is an entry for each upload, and an index by destination
+    collection id and file name, so when a new datapackage shows up,
+    finding its entry is a dict lookup. The same file name can be sent to
+    a collection more than once, on its own and in a group, so the entry
+    whose file names are the package's sources is the one picked. We also
+    remember which packages in each collection we have already looked at,
+    so each package is only looked at once, and which ones were still
+    being processed, so those can be asked for by id. A collection is
+    listed again after LIST_EVERY seconds, twice as long each time a
+    listing brings nothing new, up to MAX_LIST_EVERY.
+    '''
+    LIST_EVERY = 2
+    MAX_LIST_EVERY = 30
+
+    def __init__(self, max_wait=120 * 60):
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._keys = iter(range(1, sys.maxsize))
+        self._pending = {}      # key -> [time, collection, prefix, name, row, file names]
+        self._by_name = {}      # (collection id, file name) -> keys of the entries with it
+        self._seen = {}         # collection id -> ids of packages already looked at
+        self._unready = {}      # collection id -> ids of packages still being processed
+        self._listing = {}      # collection id -> [time of the next listing, seconds between]
+        self._running = False   # is the reconcile thread running?
+
+    def add(self, collection, fnames, prefix, planned, row=None):
+        '''
+        Remember an upload of the files named fnames. row is the fingerprint
+        of the .csv row it came from. Returns True if the caller needs to
+        start the reconcile thread.
+        '''
+        with self._lock:
+            key = next(self._keys)
+            self._pending[key] = [time.time(), collection, prefix, planned, row,
+                                  frozenset(fnames)]
+            for fname in fnames:
+                self._by_name.setdefault((collection.id, fname), []).append(key)
+            self._listing.pop(collection.id, None)   # look for it soon
+            start = not self._running
+            self._running = True
+        return start
+
+    def prime(self, collection, items):
+        '''
+        Before the first agent upload into a collection, note what is
+        already there, so we never have to look at those packages. items
+        is what is in the collection, it is only read the first time.
+        '''
+        with self._lock:
+            if collection.id in self._seen:
+                return
+        items = set(item.id for item in items)
+        with self._lock:
+            self._seen.setdefault(collection.id, items)
+
+    def count(self):
+        '''
+        How many uploads are we still looking for?
+        '''
+        return len(self._pending)
+
+    def rows(self):
+        '''
+        The fingerprints of the rows with uploads we are still looking for.
+        '''
+        with self._lock:
+            return set(entry[4] for entry in self._pending.values())
+
+    def collections(self):
+        '''
+        The collections that we are waiting on.
+        '''
+        with self._lock:
+            return list({entry[1].id: entry[1] for entry in self._pending.values()}.values())
+
+    def is_new(self, coll_id, pkg_id):
+        '''
+        True if we have not looked at this package before.
+        '''
+        return (pkg_id not in self._seen.get(coll_id, ()) and
+                pkg_id not in self._unready.get(coll_id, ()))
+
+    def seen(self, coll_id, pkg_id):
+        '''
+        Don't look at this package again.
+        '''
+        with self._lock:
+            self._seen.setdefault(coll_id, set()).add(pkg_id)
+            self._unready.get(coll_id, set()).discard(pkg_id)
+
+    def not_ready(self, coll_id, pkg_id):
+        '''
+        The package is still being processed, ask for it by id next pass.
+        '''
+        with self._lock:
+            self._unready.setdefault(coll_id, set()).add(pkg_id)
+
+    def waiting_on(self, coll_id):
+        '''
+        The ids of the packages in a collection that were still being processed.
+        '''
+        with self._lock:
+            return list(self._unready.get(coll_id, ()))
+
+    def due(self, coll_id):
+        '''
+        True if it is time to list the collection again.
+        '''
+        with self._lock:
+            entry = self._listing.get(coll_id)
+            return entry is None or time.time() >= entry[0]
+
+    def listed(self, coll_id, found):
+        '''
+        The collection was just listed. found is True if there were new
+        packages in it.
+        '''
+        with self._lock:
+            entry = self._listing.get(coll_id)
+            if found or entry is None:
+                wait = self.LIST_EVERY
+            else:
+                wait = min(entry[1] * 2, self.MAX_LIST_EVERY)
+            self._listing[coll_id] = [time.time() + wait, wait]
+
+    def match(self, coll_id, fnames):
+        '''
+        Return and forget the entry for a package with sources named fnames,
+        None if it is not ours. An entry for exactly those files comes
+        first, then the oldest one with any of them.
+        '''
+        fnames = frozenset(fnames)
+        with self._lock:
+            keys = [key for fname in fnames for key in self._by_name.get((coll_id, fname), ())]
+            if not keys:
+                return None
+            exact = [key for key in keys if self._pending[key][5] == fnames]
+            return self._forget(min(exact or keys))
+
+    def _forget(self, key):
+        '''
+        Drop an entry, with the lock held, and return it.
+        '''
+        entry = self._pending.pop(key)
+        for fname in entry[5]:
+            index = (entry[1].id, fname)
+            self._by_name[index].remove(key)
+            if not self._by_name[index]:
+                del self._by_name[index]
+        return entry
+
+    def expire(self, max_wait=None):
+        '''
+        Give up on, and return, the entries we have waited longer than
+        max_wait seconds for, all of them if it is 0.
+        '''
+        max_wait = self.max_wait if max_wait is None else max_wait
+        now = time.time()
+        with self._lock:
+            old = [key for key, entry in self._pending.items()
+                   if now - entry[0] >= max_wait]
+            return [self._forget(key) for key in old]
+
+    def stopped(self):
+        '''
+        Called by the reconcile thread when the upload is cancelled.
+        '''
+        with self._lock:
+            self._running = False
+
+    def finished(self):
+        '''
+        Called by the reconcile thread. Returns True, and marks the thread
+        as not running, if there is nothing left to look for.
+        '''
+        with self._lock:
+            if self._pending:
+                return False
+            self._running = False
+            return True
+
+
+class SequentialReader:
+    '''
+    Read a file front to back once, the way we read recordings to copy or
+    check them, without filling the page cache with data we will not read
+    again. The kernel is told the file is read sequentially, to read ahead
+    the next few chunks, and that the chunks already read can go. Copies
+    use os.sendfile so the data never comes into python; chunks() reads
+    into one buffer that is reused. Where the os does not have these
+    (Windows), it is plain reads.
+    '''
+    CHUNK = 8 * MEGABYTE
+    AHEAD = 4       # chunks to ask the kernel to read ahead
+
+    def __init__(self, path, chunk=CHUNK):
+        self.path = path
+        self.chunk = chunk
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.size = os.fstat(self._fd).st_size
+        self._advise(0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Done reading.
+        '''
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _advise(self, offset, length, advice):
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self._fd, offset, length, getattr(os, advice))
+            except OSError:
+                pass
+
+    def _step(self, offset, length):
+        '''
+        length bytes at offset have been read, drop them and read ahead.
+        '''
+        self._advise(offset, length, 'POSIX_FADV_DONTNEED')
+        self._advise(offset + length, self.AHEAD * self.chunk, 'POSIX_FADV_WILLNEED')
+
+    def chunks(self):
+        '''
+        Yield the file a chunk at a time as a memoryview into a buffer
+        that is reused, so it is only good until the next chunk.
+        '''
+        buf = bytearray(self.chunk)
+        view = memoryview(buf)
+        offset = 0
+        self._advise(0, self.AHEAD * self.chunk, 'POSIX_FADV_WILLNEED')
+        while True:
+            count = os.readv(self._fd, [buf]) if hasattr(os, 'readv') else self._read_into(buf)
+            if not count:
+                break
+            yield view[:count]
+            self._step(offset, count)
+            offset += count
+
+    def _read_into(self, buf):
+        data = os.read(self._fd, len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def copy_to(self, dst):
+        '''
+        Copy the file to dst. Returns the number of bytes copied.
+        '''
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+                         0o644)
+        try:
+            offset = 0
+            if hasattr(os, 'sendfile'):
+                self._advise(0, self.AHEAD * self.chunk, 'POSIX_FADV_WILLNEED')
+                try:
+                    while offset < self.size:
+                        count = os.sendfile(out_fd, self._fd, offset, self.chunk)
+                        if not count:
+                            break
+                        self._step(offset, count)
+                        offset += count
+                    return offset
+                except OSError:
+                    if offset:
+                        raise
+                    # no file to file sendfile here, copy the slow way
+            for chunk in self.chunks():
+                offset += len(chunk)
+                while chunk:
+                    chunk = chunk[os.write(out_fd, chunk):]
+            return offset
+        finally:
+            os.close(out_fd)
+
+
+class StagingCache:
+    '''
+    Copy the files we are about to upload from a slow source, like an NFS
+    export, to a local disk, a few files ahead of the uploader, so a stalled
+    read on the source does not stall the upload. The copies keep their
+    file names, since the site names the datapackage after the file.
+    At most max_bytes are kept, least recently used copies go first.
+    A copy is only used if the source still has the size and modification
+    time it had when it was copied. The index is kept in the staging
+    directory, so copies left from the last run can be used again.
+    '''
+    INDEX = 'index.json'
+
+    def __init__(self, root, depth=4, max_bytes=20 * 1024 * MEGABYTE, workers=2, report=print):
+        self.root = root
+        self._report = report
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.staged = 0
+        self.reused = 0
+        self.stalled = 0.0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # source -> [copy, size, mtime_ns]
+        self._used = 0
+        self._pinned = {}               # source -> count, being copied or uploaded
+        self._futures = {}
+        self._upcoming = iter(())
+        self._queue = deque()           # planned files not fetched yet, at most depth
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _copy_path(self, src):
+        digest = hashlib.sha1(os.path.abspath(src).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, digest, os.path.basename(src))
+
+    def _load(self):
+        '''
+        Pick up the copies from the last run, clean out anything else.
+        '''
+        try:
+            with open(os.path.join(self.root, self.INDEX)) as inp:
+                saved = json.load(inp)
+        except (OSError, ValueError):
+            saved = []
+        for src, dst, size, mtime in saved:
+            try:
+                if os.path.getsize(dst) == size:
+                    self._entries[src] = [dst, size, mtime]
+                    self._used += size
+            except OSError:
+                pass
+        keep = {os.path.dirname(ent[0]) for ent in self._entries.values()}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and path not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _save(self):
+        with self._lock:
+            saved = [[src] + ent for src, ent in self._entries.items()
+                     if src not in self._pinned]
+        try:
+            with open(os.path.join(self.root, self.INDEX), 'w') as out:
+                json.dump(saved, out)
+        except OSError as ex:
+            self._report('Could not save the staging index, error is {}.'.format(str(ex)))
+
+    def _drop(self, src):
+        ent = self._entries.pop(src, None)
+        if ent:
+            self._used -= ent[1]
+            shutil.rmtree(os.path.dirname(ent[0]), ignore_errors=True)
+
+    def _make_room(self, size):
+        '''
+        Evict least recently used copies until size more bytes fit.
+        '''
+        for src in list(self._entries):
+            if self._used + size <= self.max_bytes:
+                break
+            if src not in self._pinned:
+                self._drop(src)
+        return self._used + size <= self.max_bytes
+
+    def _pin(self, src):
+        self._pinned[src] = self._pinned.get(src, 0) + 1
+
+    def _unpin(self, src):
+        count = self._pinned.get(src, 0) - 1
+        if count > 0:
+            self._pinned[src] = count
+        else:
+            self._pinned.pop(src, None)
+
+    def _fresh(self, src, stat):
+        ent = self._entries.get(src)
+        return (ent is not None and ent[1] == stat.st_size and ent[2] == stat.st_mtime_ns
+                and os.path.exists(ent[0]) and os.path.getsize(ent[0]) == ent[1])
+
+    def _stage(self, src):
+        '''
+        Copy src to the staging directory if there is not a good copy
+        already. Returns the path to the copy, or None to use the source.
+        '''
+        try:
+            stat = os.stat(src)
+        except OSError:
+            return None
+        dst = self._copy_path(src)
+        with self._lock:
+            if self._fresh(src, stat):
+                self._entries.move_to_end(src)
+                self.reused += 1
+                return self._entries[src][0]
+            if src in self._pinned:     # another thread is on it
+                return None
+            self._drop(src)
+            if not self._make_room(stat.st_size):
+                return None
+            self._entries[src] = [dst, stat.st_size, stat.st_mtime_ns]
+            self._used += stat.st_size
+            self._pin(src)
+        good = False
+        try:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with SequentialReader(src) as reader:
+                reader.copy_to(dst)
+            after = os.stat(src)
+            good = (os.path.getsize(dst) == stat.st_size and after.st_size == stat.st_size
+                    and after.st_mtime_ns == stat.st_mtime_ns)
+            if not good:
+                self._report('{} changed while it was being staged'.format(src))
+        except OSError as ex:
+            self._report('Could not stage {}, error is {}.'.format(src, str(ex)))
+        with self._lock:
+            self._unpin(src)
+            if not good:
+                self._drop(src)
+                return None
+            self.staged += 1
+        return dst
+
+    def plan(self, files):
+        '''
+        The source files, in the order they will be uploaded. This can be
+        an iterator, it is only read depth files ahead of the uploads.
+        '''
+        with self._lock:
+            self._upcoming = iter(files)
+            self._queue = deque()
+            self._futures = {}
+        self._look_ahead()
+
+    def _look_ahead(self):
+        with self._lock:
+            while len(self._queue) < self.depth:
+                src = next(self._upcoming, None)
+                if src is None:
+                    break
+                self._queue.append(src)
+            for src in self._queue:
+                if src not in self._futures:
+                    self._futures[src] = self._pool.submit(self._stage, src)
+
+    def _advance(self, src):
+        '''
+        src is being fetched, drop it and the planned files before it,
+        which were skipped, from the queue. Call with the lock held.
+        '''
+        while True:
+            if not self._queue:
+                nxt = next(self._upcoming, None)
+                if nxt is None:
+                    return
+                self._queue.append(nxt)
+            head = self._queue.popleft()
+            if head == src:
+                return
+            future = self._futures.pop(head, None)
+            if future:
+                future.cancel()
+
+    def _fetch_one(self, src):
+        with self._lock:
+            future = self._futures.pop(src, None)
+            self._advance(src)
+        self._look_ahead()
+        start = time.time()
+        dst = future.result() if future else self._stage(src)
+        try:
+            stat = os.stat(src)
+        except OSError:
+            return src
+        with self._lock:
+            if dst and not self._fresh(src, stat):
+                dst = None
+        if dst is None and future:
+            dst = self._stage(src)      # source changed since it was copied
+        self.stalled += time.time() - start
+        if dst is None:
+            return src
+        with self._lock:
+            if src not in self._entries:
+                return src
+            self._pin(src)
+        return dst
+
+    def fetch(self, files):
+        '''
+        The staged copy of a file, or of each file in a list, waiting
+        for the copy if it is not done. Falls back to the source file.
+        Copies stay put until release is called.
+        '''
+        if isinstance(files, str):
+            return self._fetch_one(files)
+        return [self._fetch_one(src) for src in files]
+
+    def release(self, files):
+        '''
+        The upload of files is done with, their copies can be evicted.
+        '''
+        with self._lock:
+            for src in [files] if isinstance(files, str) else files:
+                if src in self._pinned:
+                    self._unpin(src)
+
+    def close(self):
+        '''
+        Stop copying ahead and save the index.
+        '''
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+        self._pool.shutdown(wait=False)
+        self._save()
+
+
+class _Inotify:
+    '''
+    Just enough of linux inotify, through ctypes, to hear about files
+    being created, written and moved into a set of directories.
+    Raises OSError if inotify is not available.
+    '''
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        libname = ctypes.util.find_library('c')
+        if not libname or not sys.platform.startswith('linux'):
+            raise OSError('inotify is not available')
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}     # watch descriptor -> directory
+
+    def add(self, path):
+        '''
+        Watch the directory path.
+        '''
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'cannot watch {}'.format(path))
+        self._dirs[wd] = path
+
+    def read(self, timeout):
+        '''
+        Wait up to timeout seconds for events. Returns the paths they are about.
+        '''
+        paths = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return paths
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return paths
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            wd, _, _, length = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name and wd in self._dirs:
+                paths.add(os.path.join(self._dirs[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        '''
+        Stop watching.
+        '''
+        os.close(self.fd)
+
+
+class DirWatcher:
+    '''
+    Watch directories for new files, and for files that are still being
+    written. Local directories are watched with inotify where we have it.
+    inotify does not hear about files written by other machines on a network
+    file system, so those directories, and all of them where there is no
+    inotify, are looked at every poll seconds. A file is handed out by
+    settled once its size and modification time have not changed for quiet
+    seconds. Files that are there when we start are not handed out unless
+    they change.
+    '''
+    NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', '9p', 'afs')
+
+    def __init__(self, dirs, poll=10):
+        self.poll = poll
+        self._dirs = list(dirs)
+        self._known = {}        # path -> (size, mtime_ns) as of the last look
+        self._moving = {}       # path -> time it last changed
+        self._last_poll = time.time()
+        self._inotify = None
+        self.polled = []
+        network = self._network_mounts()
+        local = []
+        for path in dirs:
+            if self._on_network(os.path.realpath(path), network):
+                self.polled.append(path)
+            else:
+                local.append(path)
+        if local:
+            try:
+                self._inotify = _Inotify()
+                for path in local:
+                    self._inotify.add(path)
+            except OSError:
+                if self._inotify:
+                    self._inotify.close()
+                self._inotify = None
+                self.polled.extend(local)
+        for path in dirs:
+            self._scan(path, baseline=True)
+
+    @staticmethod
+    def _network_mounts():
+        '''
+        The mount points of network file systems, longest first.
+        '''
+        mounts = []
+        try:
+            with open('/proc/mounts') as inp:
+                for line in inp:
+                    fields = line.split()
+                    if len(fields) > 2 and fields[2].startswith(DirWatcher.NETWORK_FS):
+                        mounts.append(fields[1].replace('\\040', ' '))
+        except OSError:
+            pass
+        return sorted(mounts, key=len, reverse=True)
+
+    @staticmethod
+    def _on_network(path, mounts):
+        return any(path == mount or path.startswith(mount.rstrip('/') + '/')
+                   for mount in mounts)
+
+    @staticmethod
+    def _stat(path):
+        '''
+        (size, mtime_ns) of a regular file, None for anything else, such as
+        a directory inotify told us was created.
+        '''
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        if not S_ISREG(info.st_mode):
+            return None
+        return info.st_size, info.st_mtime_ns
+
+    def _note(self, path, stat, now):
+        if stat is None:
+            self._known.pop(path, None)
+            self._moving.pop(path, None)
+        elif self._known.get(path) != stat:
+            self._known[path] = stat
+            self._moving[path] = now
+
+    def _scan(self, path, baseline=False):
+        now = time.time()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if baseline:
+                        self._known[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                    else:
+                        self._note(entry.path, (stat.st_size, stat.st_mtime_ns), now)
+        except OSError:
+            pass
+
+    def rescan(self):
+        '''
+        Look at every directory now, for files that showed up while nobody
+        was calling wait, or that inotify dropped when its queue filled up.
+        '''
+        for path in self._dirs:
+            self._scan(path)
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds for something to happen.
+        '''
+        if self._inotify:
+            now = time.time()
+            for path in self._inotify.read(timeout):
+                self._note(path, self._stat(path), now)
+        else:
+            time.sleep(timeout)
+        if self.polled and time.time() - self._last_poll >= self.poll:
+            self._last_poll = time.time()
+            for path in self.polled:
+                self._scan(path)
+
+    def settled(self, quiet):
+        '''
+        The new or changed files that have been left alone for quiet seconds.
+        '''
+        now = time.time()
+        done = []
+        for path, since in list(self._moving.items()):
+            stat = self._stat(path)
+            if stat != self._known.get(path):
+                self._note(path, stat, now)
+            elif now - since >= quiet:
+                del self._moving[path]
+                done.append(path)
+        return sorted(done)
+
+    def close(self):
+        '''
+        Stop watching.
+        '''
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+
+class RowLedger:
+    '''
+    Remembers which rows of a .csv file were uploaded without errors, so a
+    re-run can skip them. A row is known by a fingerprint of everything
+    that decides what it uploads and where: the destination it inherits
+    from the rows above it, the prefix, the file entry, whether extensions
+    are added, and the name, size and modification time of every file the
+    entry matches. Change any of those, or add a file that matches a
+    wildcard, and the row is done again.
+    '''
+    def __init__(self, path, csv_name):
+        self.path = path
+        self._key = os.path.abspath(csv_name)
+        self._saved = {}
+        try:
+            with open(path) as inp:
+                self._saved = json.load(inp)
+        except (OSError, ValueError):
+            pass
+        self._done = set(self._saved.get(self._key, []))
+
+    @staticmethod
+    def default_path(dataset_id):
+        '''
+        Where we keep the row fingerprints for a dataset.
+        '''
+        safe = ''.join(c if c.isalnum() or c in '-_' else '_' for c in dataset_id)
+        return os.path.join(STATE_DIR, 'rows-' + safe + '.json')
+
+    @staticmethod
+    def fingerprint(row, files, add_ext):
+        '''
+        The fingerprint of a row, files is the list of files it matched.
+        '''
+        digest = hashlib.sha1(repr((row.dest, row.prefix, row.src_file,
+                                    bool(add_ext))).encode('utf-8'))
+        for src in files:
+            try:
+                stat = os.stat(src)
+                digest.update(repr((src, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+            except OSError:
+                digest.update(repr((src, None)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def has(self, fprint):
+        '''
+        Was this row done before?
+        '''
+        return fprint in self._done
+
+    def add(self, fprint):
+        '''
+        This row is done.
+        '''
+        self._done.add(fprint)
+
+    def save(self, current):
+        '''
+        Save the fingerprints of the rows that are done, forgetting the
+        ones that are not in the .csv file any more.
+        '''
+        self._saved[self._key] = sorted(self._done & current)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as out:
+            json.dump(self._saved, out)
+
+
+class ProcessingRates:
+    '''
+    How fast the site processes uploaded files of each type, learned from
+    the packages we wait on while they are UNAVAILABLE, and kept under
+    STATE_DIR so the next run starts out knowing. From the type and size
+    of a package we guess how long it should take, which is shown while we
+    wait, and how long to wait before putting it off until the uploads are
+    done. A type is known by the extension of the biggest file in the
+    package. Rates are bytes per second, after OVERHEAD.
+    '''
+    OVERHEAD = 30               # seconds it takes for any package, however small
+    DEFAULT_RATE = MEGABYTE     # bytes per second for a type we have not seen
+    SLACK = 3                   # wait this many times the guess before giving up
+    MIN_BUDGET = 5 * 60
+    MAX_BUDGET = 120 * 60       # also the wait when we know nothing about the package
+    WEIGHT = 0.3                # of each new package in the running average
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._rates = {}        # extension -> [bytes per second, packages seen]
+        try:
+            with open(path) as inp:
+                self._rates = json.load(inp)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def default_path():
+        '''
+        Where we keep the rates.
+        '''
+        return os.path.join(STATE_DIR, 'processing-rates.json')
+
+    @staticmethod
+    def kind(sizes):
+        '''
+        The type and total size of a package from [(file name, size), ...]
+        of the files in it. The size is None if there are no files.
+        '''
+        if not sizes:
+            return '', None
+        biggest = max(sizes, key=lambda pair: pair[1])[0]
+        return os.path.splitext(biggest)[1].lower(), sum(size for _, size in sizes)
+
+    def estimate(self, ext, size):
+        '''
+        Seconds a package should take, None if we do not know its size.
+        '''
+        if size is None:
+            return None
+        with self._lock:
+            rate = self._rates.get(ext, [self.DEFAULT_RATE])[0]
+        return self.OVERHEAD + size / rate
+
+    def budget(self, ext, size):
+        '''
+        Seconds to wait on a package before giving up on it for now.
+        '''
+        guess = self.estimate(ext, size)
+        if guess is None:
+            return self.MAX_BUDGET
+        return min(self.MAX_BUDGET, max(self.MIN_BUDGET, self.SLACK * guess))
+
+    def learn(self, ext, size, seconds):
+        '''
+        A package of this type and size took seconds to process. Packages
+        under a megabyte, or done inside OVERHEAD, say more about the
+        overhead than the rate and are ignored.
+        '''
+        if size is None or size < MEGABYTE or seconds <= self.OVERHEAD:
+            return
+        rate = max(size / (seconds - self.OVERHEAD), 1.0)
+        with self._lock:
+            entry = self._rates.get(ext)
+            if entry is None:
+                self._rates[ext] = [rate, 1]
+            else:
+                entry[0] += self.WEIGHT * (rate - entry[0])
+                entry[1] += 1
+
+    def save(self):
+        '''
+        Save the rates for the next run.
+        '''
+        with self._lock:
+            rates = dict(self._rates)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as out:
+            json.dump(rates, out)
+
+
+class XlsxRows:
+    '''
+    The rows of an .xlsx workbook, one at a time, as lists of strings the
+    way csv.reader gives them, so the workbook can be used without saving
+    it as a .csv file first. The sheet is the one that was showing when the
+    workbook was saved, which is the one excel saves as a .csv file. The
+    sheet is parsed as it is read, only the shared strings and the cell
+    formats are kept in memory. Rows and cells that are not in the file,
+    because they are empty, come out as empty strings, and every row is as
+    wide as the sheet. Whole numbers come out without a .0, and dates as
+    yyyy-mm-dd.
+    '''
+    MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+    PKG = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+    DATE_FORMATS = set(range(14, 23)) | set(range(45, 48))   # built in date and time formats
+
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path)
+        try:
+            self._epoch = datetime(1899, 12, 30)
+            self._sheet = self._active_sheet()
+            self._strings = self._shared_strings()
+            self._dates = self._date_styles()
+        except Exception:
+            self._zip.close()
+            raise
+        self._rows = self._read_rows()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+    def close(self):
+        self._rows.close()
+        self._zip.close()
+
+    def _parse(self, name):
+        with self._zip.open(name) as inp:
+            return ElementTree.parse(inp).getroot()
+
+    def _active_sheet(self):
+        '''
+        The name in the zip file of the sheet that was showing.
+        '''
+        book = self._parse('xl/workbook.xml')
+        props = book.find(self.MAIN + 'workbookPr')
+        if props is not None and props.get('date1904') in ('1', 'true'):
+            self._epoch = datetime(1904, 1, 1)
+        view = book.find(self.MAIN + 'bookViews/' + self.MAIN + 'workbookView')
+        sheets = book.findall(self.MAIN + 'sheets/' + self.MAIN + 'sheet')
+        active = int(view.get('activeTab', 0)) if view is not None else 0
+        rel_id = sheets[min(active, len(sheets) - 1)].get(self.REL + 'id')
+        for rel in self._parse('xl/_rels/workbook.xml.rels').iter(self.PKG + 'Relationship'):
+            if rel.get('Id') == rel_id:
+                target = rel.get('Target')
+                return target[1:] if target.startswith('/') else 'xl/' + target
+        raise KeyError('There is no sheet {} in the workbook'.format(rel_id))
+
+    def _shared_strings(self):
+        strings = []
+        try:
+            inp = self._zip.open('xl/sharedStrings.xml')
+        except KeyError:
+            return strings
+        with inp:
+            context = ElementTree.iterparse(inp, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'end' and elem.tag == self.MAIN + 'si':
+                    parts = (elem.findall(self.MAIN + 't') or
+                             elem.findall(self.MAIN + 'r/' + self.MAIN + 't'))
+                    strings.append(''.join(part.text or '' for part in parts))
+                    root.clear()
+        return strings
+
+    def _date_styles(self):
+        '''
+        The cell styles that show numbers as dates.
+        '''
+        try:
+            styles = self._parse('xl/styles.xml')
+        except KeyError:
+            return set()
+        dates = set(self.DATE_FORMATS)
+        for fmt in styles.iter(self.MAIN + 'numFmt'):
+            code = re.sub(r'"[^"]*"|\[[^]]*\]|\\.', '', fmt.get('formatCode', '')).lower()
+            if any(part in code for part in 'dy') or 'mm' in code:
+                dates.add(int(fmt.get('numFmtId')))
+        cell_xfs = styles.find(self.MAIN + 'cellXfs')
+        if cell_xfs is None:
+            return set()
+        return set(idx for idx, xf in enumerate(cell_xfs)
+                   if int(xf.get('numFmtId', 0)) in dates)
+
+    @staticmethod
+    def _column(ref):
+        '''
+        The column number, from 0, of a cell reference like AB12.
+        '''
+        col = 0
+        for char in ref:
+            if not char.isalpha():
+                break
+            col = col * 26 + ord(char.upper()) - ord('A') + 1
+        return col - 1
+
+    def _value(self, kind, style, text):
+        '''
+        The text for a cell, as excel shows it.
+        '''
+        if kind == 's':
+            return self._strings[int(text)] if text else ''
+        if kind == 'b':
+            return 'TRUE' if text == '1' else 'FALSE'
+        if kind != 'n' or not text:
+            return text
+        number = float(text)
+        if style is not None and int(style) in self._dates:
+            when = self._epoch + timedelta(days=number)
+            if when.hour or when.minute or when.second:
+                return when.strftime('%Y-%m-%d %H:%M:%S')
+            return when.strftime('%Y-%m-%d')
+        if number.is_integer() and abs(number) < 1e15:
+            return str(int(number))
+        return text
+
+    def _read_rows(self):
+        target = _SheetTarget()
+        parser = ElementTree.XMLParser(target=target)
+        width = 0
+        done = 0
+        with self._zip.open(self._sheet) as inp:
+            while True:
+                chunk = inp.read(64 * 1024)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                rows, target.rows = target.rows, []
+                width = max(width, target.width)
+                for row_num, cells in rows:
+                    values = {}
+                    for col, kind, style, text in cells:
+                        value = self._value(kind, style, text)
+                        if value:
+                            values[col] = value
+                    if values:
+                        width = max(width, max(values) + 1)
+                    while done < row_num - 1:
+                        yield [''] * width
+                        done += 1
+                    yield [values.get(idx, '') for idx in range(width)]
+                    done += 1
+            parser.close()
+
+
+class _SheetTarget:
+    '''
+    The cells of the rows of an .xlsx sheet as it is parsed, for XlsxRows.
+    Nothing else in the sheet is kept. Takes rows as
+    (row number, [(column, type, style, text), ...]).
+    '''
+    ROW = XlsxRows.MAIN + 'row'
+    CELL = XlsxRows.MAIN + 'c'
+    TEXT = (XlsxRows.MAIN + 'v', XlsxRows.MAIN + 't')
+    DIMENSION = XlsxRows.MAIN + 'dimension'
+
+    def __init__(self):
+        self.rows = []
+        self.width = 0
+        self._row_num = 0
+        self._cells = None
+        self._cell = None
+        self._text = None
+
+    def start(self, tag, attrs):
+        if tag == self.CELL and self._cells is not None:
+            ref = attrs.get('r')
+            col = XlsxRows._column(ref) if ref else (self._cells[-1][0] + 1 if self._cells else 0)
+            self._cell = [col, attrs.get('t', 'n'), attrs.get('s'), '']
+        elif tag in self.TEXT and self._cell is not None:
+            self._text = []
+        elif tag == self.ROW:
+            self._row_num = int(attrs.get('r', self._row_num + 1))
+            self._cells = []
+        elif tag == self.DIMENSION:
+            last = attrs.get('ref', '').split(':')[-1]
+            if last:
+                self.width = XlsxRows._column(last) + 1
+
+    def data(self, text):
+        if self._text is not None:
+            self._text.append(text)
+
+    def end(self, tag):
+        if tag in self.TEXT and self._text is not None:
+            self._cell[3] += ''.join(self._text)
+            self._text = None
+        elif tag == self.CELL and self._cell is not None:
+            self._cells.append(tuple(self._cell))
+            self._cell = None
+        elif tag == self.ROW and self._cells is not None:
+            self.rows.append((self._row_num, self._cells))
+            self._cells = None
+
+    def close(self):
+        pass
+
+
+# One step of a sync. kind is one of mkdir, upload, replace, rename or delete.
+SyncAction = namedtuple('SyncAction', 'kind dest dest_name prefix files pkg_ids')
+
+
+# One row of the .csv file with everything carried down from the rows above
+# it filled in. dest is the destination collection path as a tuple of
+# collection names under the dataset, () is the dataset itself.
+RowDest = namedtuple('RowDest', 'dest prefix dest_name src_file')
+
+
+class PlanUnit:
+    '''
+    One upload from a row: a single file, or the files in a [] group.
+    These are made as the rows are expanded and thrown away once used,
+    there can be hundreds of thousands of them.
+    '''
+    __slots__ = ('row', 'files', 'group')
+
+    def __init__(self, row, files, group):
+        self.row = row
+        self.files = files
+        self.group = group
+
+
 class UploadBlackfynn:
     """
     Command line class to upload files to Blackfynn datasets.
@@ -65,11 +2218,20 @@ class UploadBlackfynn:
         'submission.csv',
         'Readme',
         'Changes',
-        'manifest.csv'
-        'manifest.xls'
+        'manifest.csv',
+        'manifest.xls',
         'manifest.xlsx'
         ]
 
+    # Blackfynn strips the extension off of file types it knows about when
+    # it names the datapackage. These are the ones we run into.
+    STRIPPED_EXTS = {
+        '.txt', '.csv', '.tsv', '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.json',
+        '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.gif', '.bmp', '.nii', '.dcm',
+        '.edf', '.nev', '.ns1', '.ns2', '.ns3', '.ns4', '.ns5', '.ns6', '.smr', '.abf',
+        '.mat', '.mef', '.nex', '.plx', '.mp4', '.avi', '.mov'
+        }
+
     # Input csv file column and row offsets
     # First real data row is destination dataset
     ROWS_TO_NAME = 3
@@ -81,17 +2243,60 @@ class UploadBlackfynn:
     DESTFOLD = 3
     SRCFILE = 4
 
+    # Threads used to create the destination folders ahead of the uploads
+    COLLECTION_WORKERS = 4
+    CREATE_TRIES = 3        # tries at creating a collection
+    EXPAND_KEEP = 2000      # file names from expanded rows kept during a run
+
     def __init__(self):
         self._profile_name = None    # users of class must set most of these
         self._csv_name = None
         self._dataset_name = None
-        self._stop_right_now = False
+        self._cancel = CancelToken()
+        self._retries = 0
         self._b_fynn = None
         self._dataset = None
         self._uploaded = 0
         self._use_agent = False
         self._add_ext = True
-        self.overwrite = None
+        self._throttle = UploadThrottle()
+        self.progress = RunProgress()
+        self._abandoned = {}     # file -> transfer thread still sending it after Stop
+        self._watching = None    # (targets, DirWatcher) from start_watch
+        self._abandoned_lock = threading.Lock()
+        self._progress_shown = 0.0
+        self._ready = ReadyCache()
+        self._coll_flight = SingleFlight()
+        self._lister = CollectionLister()
+        self._listed = {}
+        self._listed_lock = threading.Lock()
+        self._snap = None
+        self._use_snapshot = True
+        self._sync = False
+        self._delete_orphans = False
+        self._name_plan = {}
+        self._snap_paths = None
+        self._expansions = None  # src_file -> _make_file_list result, see _expanding
+        self._expanded = 0       # file names in them
+        self._expand_lock = threading.Lock()
+        self._pending = PendingUploads()
+        self._pkgs = PackageCache(self._get_pkg)
+        self._rates = ProcessingRates(ProcessingRates.default_path())
+        self._deferred = []
+        self._slow = 0
+        self._row = None         # fingerprint of the .csv row being uploaded
+        self._failed_rows = set()
+        self._processing = 0     # packages _okay_to_update is waiting on
+        self._tally_lock = threading.Lock()
+        self.events = EventBus()
+        self.show_limit = None
+        self.idle = None
+        self._errors = 0
+        self._sent_bytes = 0
+        self._stage = None
+        self._stage_opts = None
+        self._batch_snaps = None
+        self._full = False
 
     def set_csv(self, csv_name):
         '''
@@ -121,105 +2326,260 @@ class UploadBlackfynn:
         '''
         self._use_agent = state
 
-    def curr_dataset(self):
+    def set_bandwidth(self, spec):
         '''
-        The gui wrapper needs this name. Return it.
+        Set the bandwidth schedule, see BandwidthSchedule for the format.
+        Returns True, '' if okay, False and the problem if not.
         '''
-        return self._dataset_name
+        try:
+            self._throttle = UploadThrottle(BandwidthSchedule(spec))
+        except ValueError as ex:
+            return False, str(ex)
+        return True, ''
+
+    def curr_limit(self):
+        '''
+        The gui wrapper shows the bandwidth limit in effect right now.
+        '''
+        return self._throttle.schedule.describe()
+
+    def set_limit_display(self, callback):
+        '''
+        callback from the gui part of this package.
+        Called with the text of the bandwidth limit in effect
+        whenever an upload starts.
+        '''
+        self.show_limit = callback
 
-    def set_overwrite(self, callback):
+    def set_idle(self, callback):
         '''
         callback from the gui part of this package.
-        we use this to request an overwrite of the
-        current line, as opposed to just printing,
-        which goes through stdout.
+        Called about four times a second while a file is being sent,
+        so the gui stays live and the Stop button works.
+        '''
+        self.idle = callback
+
+    def set_staging(self, path, depth=4, max_gb=20):
+        '''
+        Copy the files to path, a directory on a fast local disk, depth
+        files ahead of the uploads, keeping at most max_gb gigabytes there.
+        For sources on a slow or flaky network file system.
+        None turns it off.
         '''
-        self.overwrite = callback
+        self._stage_opts = (path, depth, max_gb) if path else None
+
+    def set_full(self, state):
+        '''
+        Go through every row of the .csv file, even the ones that were
+        uploaded before and have not changed since.
+        '''
+        self._full = state
+
+    def set_use_snapshot(self, state):
+        '''
+        Use the saved snapshot of the dataset, if there is one.
+        '''
+        self._use_snapshot = state
+
+    def set_sync(self, state, delete_orphans=False):
+        '''
+        In sync mode, we compare the .csv file with the dataset and only
+        do what it takes to make the dataset match. Files that are on the
+        site but not in the .csv file are deleted if delete_orphans is set.
+        '''
+        self._sync = state
+        self._delete_orphans = delete_orphans
+
+    def curr_dataset(self):
+        '''
+        The gui wrapper needs this name. Return it.
+        '''
+        return self._dataset_name
 
     @staticmethod
     def get_profile_list():
         """
         The gui wrapper needs the list
+        Read straight from the blackfynn config file, the way the blackfynn
+        package does, so we do not have to import it just for this.
         """
-        settings = Settings()
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.environ.get('BLACKFYNN_LOCAL_DIR') or
+                                 os.path.join(os.path.expanduser('~'), '.blackfynn'),
+                                 'config.ini'))
+        default_token = config.get('global', 'api_token', fallback=None)
         list_profile = []
-        for item in settings.profiles.items():
-            if item[0] not in ['global']:
-                if item[1]['api_token']:
-                    list_profile.append(item[0])
+        for name in config.sections():
+            if name not in ['global']:
+                token = config.get(name, 'api_token', fallback=default_token)
+                if token and token != 'none':
+                    list_profile.append(name)
         return list_profile
 
 
-    def chk_files_exist(self):
+    def chk_files_exist(self, cancel=None):
         '''
         Returns True if all the files in the .csv file exist. False if not.
         Wildcards supported in file names, not dirs, no recursion.
+        How far along it is goes out as 'checking' events, and missing
+        files are reported as they are found. If cancel, a CancelToken,
+        is cancelled, the check stops and returns False.
         '''
         if not self._csv_name:
-            print("No .csv file selected, nothing to check\n")
+            self.events.emit('error', 'No .csv file selected, nothing to check')
             return False
         okay = True
-        print('Making sure that files to upload exist. . .', end='')
-        with open(self._csv_name) as csvfile:
-            fnames = csv.reader(csvfile, delimiter=',')
+        self.events.emit('message', 'Making sure that files to upload exist. . .')
+        with self._manifest_rows() as fnames:
             for row in range(self.ROWS_TO_DSET):  # skip info in first rows
                 try:
                     next(fnames)
                 except Exception as ex:
-                    print('Error reading row {} of {} file, '
-                          'error is {}.'.format(row, self._csv_name, str(ex)))
+                    self.events.emit('error', 'Error reading row {row} of {csv} file, '
+                                     'error is {error}.', row=row, csv=self._csv_name,
+                                     error=str(ex))
             # turn list(s) of files into one list of strings
-            files = [file for file in [name[self.SRCFILE] for name in fnames]
+            files = [file for file in [name[self.SRCFILE] for name in fnames
+                                       if len(name) > self.SRCFILE]
                      if file and not file.isspace()]
             # Remove optional leading and trailing grouping brackets
             files = [fn.strip('[]') for fn in files]
             files = ','.join(files).split(',')
-            for check in files:
+            total = len(files)
+            missing = 0
+            shown = 0.0
+            for done, check in enumerate(files):
+                if cancel is not None and cancel.cancelled:
+                    self.events.emit('cancelled', 'File check stopped after {done} of {total} '
+                                     'entries, {missing} missing so far', done=done,
+                                     total=total, missing=missing)
+                    return False
+                if time.time() - shown >= 0.25:
+                    shown = time.time()
+                    self.events.emit('checking', 'Checked {done} of {total} entries',
+                                     done=done, total=total, missing=missing)
                 pathchk = os.path.dirname(check)
                 if pathchk and any(wild in '*?' for wild in pathchk):
-                    print('This program does not support wildcards'
-                          'in path names (okay in file names), skipping .' + pathchk)
+                    self.events.emit('skipped', 'This program does not support wildcards '
+                                     'in path names (okay in file names), skipping {path}',
+                                     path=pathchk)
                     continue
                 expanded_files = glob.glob(check)
                 if not expanded_files:
-                    print('\nThe path {} or the file {} does not exist.'.format(
-                        pathchk, os.path.basename(check)), end='')
+                    self.events.emit('error', 'The path {path} or the file {file} does not exist.',
+                                     path=pathchk, file=os.path.basename(check))
+                    missing += 1
                     okay = False
+            self.events.emit('checking', 'Checked {done} of {total} entries', done=total,
+                             total=total, missing=missing)
         if okay:
-            print('looking good!')
+            self.events.emit('message', 'Files look good!')
+        return okay
+
+    def check_only(self, csv_files):
+        '''
+        Check the .csv files without asking anything or connecting to
+        Blackfynn: there is a dataset name, and the files to upload exist.
+        Returns True if they all look good.
+        '''
+        okay = True
+        for csv_name in csv_files:
+            if not os.path.exists(csv_name):
+                self.events.emit('error', 'The file {csv} does not exist.', csv=csv_name)
+                okay = False
+                continue
+            self.set_csv(csv_name)
+            if not self._dataset_name:
+                self.events.emit('error', 'There is not a dataset name in {csv} in row 4, '
+                                 'column 1.', csv=csv_name)
+                okay = False
+            if not self.chk_files_exist():
+                okay = False
         return okay
 
     def _chk_on_blackfynn(self, collection, fname):
         '''
         Check to see if the fname exists in the current collection by looking
-        at the sources attribute.
+        at the sources attribute. If the snapshot knows about this
+        collection, it has the answer without asking the server, unless
+        it has a package that may hold fname but was still being processed,
+        then we wait on that package and look at its sources. Otherwise
+        the collection is listed only as far as it takes to find fname, and
+        the source names seen so far are kept, so the next file picks up
+        where this one left off instead of starting over. Files sent this
+        run are added to those names, see _note_sent.
         '''
-        have_file = False
-        for item in collection:
-            if isinstance(item, Collection):
-                continue
-            if not item.sources:
-                item = self._okay_to_update(item) # if re-running program
-                                                  # pkg may not be ready yet
-            true_names = item.sources
-            if not true_names:
-                print('Data package available, but source attribute not available.')
-            for lookup in true_names:
-                realfile = os.path.basename(lookup.s3_key)
-                if realfile == fname:
-                    have_file = True
+        with self._listed_lock:
+            listing = self._listed.get(collection.id)
+            if listing is not None and fname in listing[1]:
+                return True
+        if self._snap and self._snap.knows(collection.id):
+            if self._snap.has_source(collection.id, fname):
+                return True
+            for pkg_id in self._snap.unsettled(collection.id, fname):
+                try:
+                    dpkg = self._okay_to_update(self._pkgs.get(pkg_id))
+                except Exception as ex:
+                    self.events.emit('error', 'Datapackage update error: {error}.',
+                                     error=str(ex))
+                    continue
+                self._snap_record(dpkg)
+                if self._snap.has_source(collection.id, fname):
+                    return True
+            return False
+        with self._listed_lock:
+            listing = self._listed.get(collection.id)
+            if listing is None:
+                listing = [self._children(collection, 'packages'), set()]
+                self._listed[collection.id] = listing
+            items, names = listing
+            while fname not in names and items is not None:
+                item = next(items, None)
+                if item is None:
+                    listing[0] = items = None
                     break
-            if have_file:
-                break
-        return have_file
+                if not item.sources:
+                    item = self._okay_to_update(item) # if re-running program
+                                                      # pkg may not be ready yet
+                true_names = item.sources
+                if not true_names:
+                    self.events.emit('error', 'Data package {name} available, but source '
+                                     'attribute not available.', name=item.name)
+                names.update(os.path.basename(lookup.s3_key) for lookup in true_names or [])
+            return fname in names
 
+    def _note_sent(self, collection, files):
+        '''
+        files were just sent to collection. A listing of it may already be
+        used up, or be past where their packages will show up, so add
+        their names to what _chk_on_blackfynn has seen there.
+        '''
+        with self._listed_lock:
+            listing = self._listed.get(collection.id)
+            if listing is None:
+                listing = [self._children(collection, 'packages'), set()]
+                self._listed[collection.id] = listing
+            listing[1].update(os.path.basename(fname) for fname in files)
 
-    @staticmethod
-    def _make_file_list(src_file):
+    def _children(self, collection, kind=None, fresh=False):
+        '''
+        What is in collection, a page at a time, see CollectionLister.
+        '''
+        return self._lister.children(self._b_fynn, collection, kind, fresh)
+
+
+    def _make_file_list(self, src_file):
         '''
         For single path/file, build a list of individual names, each in a list.
         For multi-path/files, inner list contains all of the matches.
+        During a run the lists are kept until they hold EXPAND_KEEP file
+        names, so the rows of a small .csv file are globbed once. Past that
+        rows are globbed again when they are needed, a big .csv file is
+        never all in memory at once.
         '''
+        with self._expand_lock:
+            if self._expansions is not None and src_file in self._expansions:
+                return self._expansions[src_file]
         expanded_files = []
         multi_list = []
         keep_together = src_file[0] == '[' and src_file[-1] == ']'
@@ -232,7 +2592,7 @@ class UploadBlackfynn:
                 continue
             flist = glob.glob(check)
             if not flist:
-                print('The path or file', check, ' does not exist')
+                self.events.emit('error', 'The path or file {file} does not exist', file=check)
                 continue
             if multi:
                 for fname in flist:
@@ -244,51 +2604,280 @@ class UploadBlackfynn:
                 expanded_files.append([multi_list])
             else:
                 expanded_files.append(multi_list)
+        nfiles = sum(1 for _ in self._flat_files(expanded_files))
+        with self._expand_lock:
+            if (self._expansions is not None and
+                    self._expanded + nfiles <= self.EXPAND_KEEP):
+                self._expansions[src_file] = expanded_files
+                self._expanded += nfiles
         return expanded_files
 
+    @contextmanager
+    def _expanding(self):
+        '''
+        Keep row expansions for a run, see _make_file_list.
+        '''
+        with self._expand_lock:
+            self._expansions = {}
+            self._expanded = 0
+        try:
+            yield
+        finally:
+            with self._expand_lock:
+                self._expansions = None
+
+
+    def busy(self):
+        '''
+        True while a transfer that was stopped is still sending in the
+        background. Starting another upload then could send its files twice.
+        '''
+        with self._abandoned_lock:
+            return bool(self._abandoned)
+
+    def _wait_abandoned(self, fname):
+        '''
+        If a stopped transfer is still sending fname, wait for it to finish
+        instead of sending it again. Returns False if stopped while waiting.
+        '''
+        with self._abandoned_lock:
+            worker = self._abandoned.get(fname)
+        if worker is None:
+            return True
+        self.events.emit('message', 'Waiting for the stopped upload of {file} to finish.',
+                         file=fname)
+        while worker.is_alive():
+            if self._cancel.sleep(1):
+                return False
+            self.events.emit('waiting', 'Waiting for the stopped upload of {file}',
+                             what='abandoned', file=fname)
+        return True
 
     def chk_exist(self, collection, dest_copy, fname, dest_name):
         '''
         Check to see if file is already on blackfynn site.
-        Complain if so.
+        Complain if so. A stopped transfer still sending the file is
+        waited on first.
         '''
+        if not self._wait_abandoned(fname):
+            return True
         if self._chk_on_blackfynn(collection, dest_copy):
-            print('File {} already uploaded to {}.'.format(fname, dest_name))
-            print('Delete it in a browser to re-upload it.', flush=True)
+            self.events.emit('skipped', 'File {file} already uploaded to {dest}.\n'
+                             'Delete it in a browser to re-upload it.',
+                             file=fname, dest=dest_name)
             return True
         return False
 
 
+    def _bandwidth_wait(self):
+        '''
+        Hold off the next upload until we are back under the bandwidth
+        limit. The schedule is checked every tick, so if we wander into a
+        full speed window we go right away. Returns False if the user
+        stopped the upload while we waited.
+        '''
+        if self.show_limit:
+            self.show_limit(self.curr_limit())
+        first_time = True
+        while True:
+            wait = self._throttle.pause_needed()
+            if not wait:
+                break
+            if self._cancel.cancelled:
+                return False
+            if first_time:
+                self.events.emit('message', 'Bandwidth limit {limit}, pausing.',
+                                 limit=self.curr_limit())
+                first_time = False
+            self.events.emit('waiting', 'Resuming in {left}', what='bandwidth',
+                             left=str(timedelta(seconds=int(wait))), seconds=wait)
+            if self._cancel.sleep(min(1, wait)):
+                return False
+        return True
+
+    def _bandwidth_charge(self, files, start, end):
+        '''
+        Tell the throttle how much we just sent.
+        '''
+        nbytes = self._file_bytes(files)
+        self._throttle.charge(nbytes, start, end)
+        self._sent_bytes += nbytes
+        self.events.emit('upload_progress', 'Elapsed time: {elapsed}', files=files,
+                         bytes=nbytes, seconds=end-start, total_bytes=self._sent_bytes,
+                         elapsed=str(timedelta(seconds=end-start)))
+        self._show_progress(force=True)
+
+    @staticmethod
+    def _file_bytes(files):
+        '''
+        The total size of files, ones we can not stat count as 0.
+        '''
+        nbytes = 0
+        for fname in files:
+            try:
+                nbytes += os.path.getsize(fname)
+            except OSError:
+                pass
+        return nbytes
+
+    def _tally(self, counter, by=1):
+        '''
+        Add to one of the run's counters, _errors, _retries, _processing or
+        _slow. They are added to from the reconcile thread and the
+        collection workers too.
+        '''
+        with self._tally_lock:
+            setattr(self, counter, getattr(self, counter) + by)
+
+    def counters(self):
+        '''
+        The numbers for a dashboard, cheap enough to read every second:
+        self.progress.status(), plus uploaded files, bytes sent, retries,
+        errors, and processing, the packages we are waiting on the site
+        to finish processing before they can be renamed.
+        '''
+        stat = self.progress.status()
+        stat.update(uploaded=self._uploaded, sent_bytes=self._sent_bytes,
+                    retries=self._retries, errors=self._errors,
+                    processing=self._pending.count() + len(self._deferred) + self._processing)
+        return stat
+
+    def _show_progress(self, force=False):
+        '''
+        The status line for the whole run, at most once a second.
+        '''
+        now = time.time()
+        if not force and now - self._progress_shown < 1:
+            return
+        self._progress_shown = now
+        stat = self.progress.status()
+        self.events.emit('progress', '{text}', text=self.progress.text(stat), **stat)
+
+    def _transfer(self, collection, files):
+        '''
+        Send files to collection. The SDK call can not be interrupted, so it
+        runs in a worker thread and we wait on it a quarter second at a time,
+        giving up if the user hits Stop. An abandoned transfer keeps going
+        in the background. Its files are remembered until it is done, see
+        busy and _wait_abandoned, so they are not sent again while it is,
+        and what it sent is charged to the bandwidth limit when it is done.
+        '''
+        result = {}
+        sending = [files] if isinstance(files, str) else files
+        nbytes = self._file_bytes(sending)
+        key = self.progress.started(nbytes, len(sending))
+
+        stage = self._stage
+
+        def _send():
+            start = time.time()
+            try:
+                send = stage.fetch(files) if stage else files
+                result['res'] = collection.upload(send, use_agent=self._use_agent,
+                                                  display_progress=True)
+                self._note_sent(collection, sending)
+            except Exception as ex:
+                result['ex'] = ex
+            finally:
+                if stage:
+                    stage.release(files)
+                with self._abandoned_lock:
+                    if result.get('abandoned'):
+                        self._throttle.charge(nbytes, start, time.time())
+                        for src in sending:
+                            self._abandoned.pop(src, None)
+
+        worker = threading.Thread(target=_send, daemon=True)
+        worker.start()
+        try:
+            while worker.is_alive():
+                worker.join(0.25)
+                if self.idle:
+                    self.idle()
+                if self._cancel.cancelled:
+                    with self._abandoned_lock:
+                        if worker.is_alive():
+                            result['abandoned'] = True
+                            for src in sending:
+                                self._abandoned[src] = worker
+                            raise UploadCancelled()
+                self._show_progress()
+        except UploadCancelled:
+            self.progress.finished(key, sent=False)
+            raise
+        self.progress.finished(key, sent='ex' not in result)
+        if 'ex' in result:
+            raise result['ex']
+        return result.get('res')
+
     def _upload_singles(self, collection, files, prefix, name):
         '''
         Upload a group of files one by one to the collection.
-        Expects a list of strings.
+        Expects a list of strings. After an error the rest of them are not
+        sent, and come off the progress.
         '''
-        for next_file in files:
-            if self._stop_right_now:
+        for idx, next_file in enumerate(files):
+            if self._cancel.cancelled:
                 return
             dest_copy = os.path.basename(next_file)
             if self.chk_exist(collection, dest_copy, next_file, name):
+                self.progress.skip(self._file_bytes([next_file]), 1)
                 continue
-            print('Uploading', next_file, ' to', name)
+            if not self._bandwidth_wait():
+                return
+            self.events.emit('upload_started', 'Uploading {files} to {dest}',
+                             files=next_file, dest=name)
             start = time.time()
+            unsent = files[idx:]
             try:
                 collection = self._wait_for_ready(collection)
-                res = collection.upload(next_file, use_agent=self._use_agent, display_progress=True)
+                if self._use_agent:
+                    self._pending.prime(collection, self._children(collection))
+                unsent = files[idx + 1:]   # _transfer accounts for this one
+                res = self._transfer(collection, next_file)
+                self._ready.invalidate(collection.id)
                 end = time.time()
-                print('Elapsed time:', (str(timedelta(seconds=end-start))))
+                self._bandwidth_charge([next_file], start, end)
                 self._uploaded += 1
+            except UploadCancelled:
+                self._ready.invalidate(collection.id)
+                self.events.emit('cancelled', 'Upload of {files} cancelled.', files=next_file)
+                return
             except AgentError as ex:
-                print('AGENT ERROR: {}'.format(str(ex)))
-                self._stop_right_now = True
+                self._tally('_errors')
+                self.events.emit('error', 'AGENT ERROR: {error}', error=str(ex))
+                self._row_failed(self._row)
+                self._skip_files(unsent)
+                self._cancel.cancel()
                 return
             except Exception as ex:
-                print('Error uploading {} to collection {}. '
-                      'Error was {}.'.format(next_file, collection.name, str(ex)))
-                end = time.time()
-                print('Elapsed time: ', str(timedelta(seconds=end-start)))
+                self._tally('_errors')
+                self.events.emit('error', 'Error uploading {files} to collection {dest}. '
+                                 'Error was {error}.\nElapsed time: {elapsed}',
+                                 files=next_file, dest=collection.name, error=str(ex),
+                                 elapsed=str(timedelta(seconds=time.time()-start)))
+                self._row_failed(self._row)
+                self._skip_files(unsent)
                 return
-            self.name_conform(res, [next_file], collection, prefix)
+            self.name_conform(res, [next_file], collection, prefix,
+                              self._planned_name(name, [next_file]))
+
+
+    def _skip_files(self, files):
+        '''
+        Files that were counted in the progress but will not be sent.
+        '''
+        if files:
+            self.progress.skip(self._file_bytes(files), len(files))
+
+
+    def _row_failed(self, row):
+        '''
+        Something in the .csv row with this fingerprint was not uploaded or
+        not renamed, so it is not marked done in the row ledger.
+        '''
+        if row is not None:
+            self._failed_rows.add(row)
 
 
     def _upload_group(self, collection, files, prefix, name):
@@ -298,32 +2887,51 @@ class UploadBlackfynn:
         is all or nothing for a group.
         '''
         for next_file in files:
-            if self._stop_right_now:
+            if self._cancel.cancelled:
                 return
             dest_copy = os.path.basename(next_file)
             if self.chk_exist(collection, dest_copy, next_file, name):
+                self.progress.skip(self._file_bytes(files), len(files))
                 return
             continue
 
-        print('Uploading', files, ' to', name)
+        if not self._bandwidth_wait():
+            return
+        self.events.emit('upload_started', 'Uploading {files} to {dest}', files=files, dest=name)
         start = time.time()
+        unsent = files
         try:
             collection = self._wait_for_ready(collection)
-            res = collection.upload(files, use_agent=self._use_agent, display_progress=True)
+            if self._use_agent:
+                self._pending.prime(collection, self._children(collection))
+            unsent = []   # _transfer accounts for them
+            res = self._transfer(collection, files)
+            self._ready.invalidate(collection.id)
             end = time.time()
-            print('Elapsed time: ', str(timedelta(seconds=end-start)))
+            self._bandwidth_charge(files, start, end)
             self._uploaded += len(files)
+        except UploadCancelled:
+            self._ready.invalidate(collection.id)
+            self.events.emit('cancelled', 'Upload of {files} cancelled.', files=files)
+            return
         except AgentError as ex:
-            print('AGENT ERROR: {}'.format(str(ex)))
-            self._stop_right_now = True
+            self._tally('_errors')
+            self.events.emit('error', 'AGENT ERROR: {error}', error=str(ex))
+            self._row_failed(self._row)
+            self._skip_files(unsent)
+            self._cancel.cancel()
             return
         except Exception as ex:
-            print('Error uploading {} to collection {}.,'
-                  'Error was {}.'.format(files, collection.name, str(ex)))
-            end = time.time()
-            print('Elapsed time: ', str(timedelta(seconds=end-start)))
+            self._tally('_errors')
+            self.events.emit('error', 'Error uploading {files} to collection {dest}. '
+                             'Error was {error}.\nElapsed time: {elapsed}',
+                             files=files, dest=collection.name, error=str(ex),
+                             elapsed=str(timedelta(seconds=time.time()-start)))
+            self._row_failed(self._row)
+            self._skip_files(unsent)
             return
-        self.name_conform(res, files, collection, prefix)
+        self.name_conform(res, files, collection, prefix,
+                          self._planned_name(name, files))
 
 
     def _upload_list(self, collection, files, prefix, name):
@@ -343,71 +2951,156 @@ class UploadBlackfynn:
                 files = [file for fn in file_list for file in fn]
                 self._upload_group(collection, files, prefix, name)
             else:
-                print('Unexpected type of file list')
+                self.events.emit('error', 'Unexpected type of file list')
                 return
 
 
+    def _find_or_create(self, collection, level):
+        '''
+        Find the collection named level in collection, create it if it is
+        not there. Since files and folder can have same name, make sure we
+        only look at collections. Returns None if we could not create it.
+        The listing is fresh, what the collection object has may be from an
+        earlier run.
+        '''
+        for curr_coll in self._children(collection, 'collections', fresh=True):
+            if curr_coll.name == level:
+                return curr_coll
+        # Note: Sometimes this fails for UF folk late at night
+        # when doing unattended uploads.
+        # The code that raises the error is:
+        # raise HTTPError(http_error_msg, response=self)
+        for attempt in range(self.CREATE_TRIES):
+            try:
+                curr_coll = collection.create_collection(level)
+                self._ready.invalidate(collection.id)
+                if self._snap:
+                    self._snap.add_collection(curr_coll.id, level, collection.id)
+                self.events.emit('collection_created', 'Created {name} in {parent}',
+                                 name=level, parent=collection.name, id=curr_coll.id)
+                return curr_coll
+            except Exception as ex:
+                self.events.emit('error', 'Error creating collection {name} in {parent},\n'
+                                 'error is {error}.', name=level, parent=collection.name,
+                                 error=str(ex))
+            if attempt + 1 < self.CREATE_TRIES:
+                self._tally('_retries')
+                if self._cancel.sleep(2 ** attempt):
+                    break
+        self._tally('_errors')
+        return None
+
+
     def _collection_chk(self, collection, paths):
         '''
         Find or create one or more collections in a collection hierarchy
-        and return the lowest collection. Since files and folder can have
-        same name, make sure we only look at collections.
+        and return the lowest collection, None if we could not get there.
+        If several threads are after the same collection, only one of them
+        looks for or creates it, the rest wait for that one to finish, so
+        we never create two folders with the same name.
         '''
         hier = paths.split('/')
         for level in hier:
-            for curr_coll in collection.items:
-                if isinstance(curr_coll, Collection) and curr_coll.name == level:
-                    break
-            else:
-                print('Creating', level, 'in', collection.name)
-                # Note: Sometimes this fails for UF folk late at night
-                # when doing unattended uploads.
-                # The code that raises the error is:
-                # raise HTTPError(http_error_msg, response=self)
-                try:
-                    curr_coll = collection.create_collection(level)
-                except Exception as ex:
-                    print('Error creating collection {},\n'
-                          'error is {}.'.format(collection.name, str(ex)))
+            parent = collection
+            curr_coll = self._coll_flight.do((parent.id, level),
+                                             lambda: self._find_or_create(parent, level))
+            if curr_coll is None:
+                return None
             curr_coll = self._wait_for_ready(curr_coll)
             collection = curr_coll  # step down into new collection
         return curr_coll
 
 
+    def _resolve_dest(self, dest):
+        '''
+        Return the collection for a destination path tuple from _walk_rows.
+        '''
+        if not dest:
+            return self._dataset
+        return self._collection_chk(self._dataset, '/'.join(dest))
+
+
+    def _precreate_tree(self, dests):
+        '''
+        Create all of the destination collections, breadth first, a level
+        at a time, with the collections in each level done in parallel.
+        This runs in the background while the uploads happen, so usually the
+        collection an upload needs is already there when it gets to it.
+        '''
+        levels = {}
+        for dest in dests:
+            for depth in range(1, len(dest) + 1):
+                levels.setdefault(depth, set()).add(dest[:depth])
+        def _make_one(dest):
+            try:
+                self._resolve_dest(dest)
+            except Exception as ex:
+                self.events.emit('error', 'Error creating collection {name},\n'
+                                 'error is {error}.', name='/'.join(dest), error=str(ex))
+        with ThreadPoolExecutor(max_workers=self.COLLECTION_WORKERS) as pool:
+            for depth in sorted(levels):
+                if self._cancel.cancelled:
+                    break
+                list(pool.map(_make_one, sorted(levels[depth])))
+
+
     def _get_dataset_name(self):
         '''
         The destination dataset name is in the .csv file. Get it and
         stuff into class var.
         '''
         working_dset = ''
-        with open(self._csv_name) as csvfile:
-            in_file = csv.reader(csvfile, delimiter=',')
-            for row in range(self.ROWS_TO_NAME):  # skip info rows
-                try:
-                    next(in_file)
-                except UnicodeDecodeError as ex:
-                    print('Error reading row {} of {} file,\n'
-                          'error is {}.'.format(row, self._csv_name, str(ex)))
-                    print('If you are using excel, save the file as a CSV (MS-DOS) .csv file')
-                    print('Unable to read the .csv file, upload aborted.')
-                    return ''
-                except Exception as ex:
-                    print('Error reading row {} of {} file,\n'
-                          'error is {}.'.format(row, self._csv_name, str(ex)))
-                    print('Unable to read the .csv file, upload aborted.')
-                    return ''
-            row = next(in_file)
+        self._dataset_name = working_dset
+        try:
+            with self._manifest_rows() as in_file:
+                for row in range(self.ROWS_TO_NAME):  # skip info rows
+                    try:
+                        next(in_file)
+                    except UnicodeDecodeError as ex:
+                        self.events.emit('error', 'Error reading row {row} of {csv} file,\n'
+                                         'error is {error}.\n'
+                                         'If you are using excel, save the file as a CSV '
+                                         '(MS-DOS) .csv file, or use the .xlsx file\n'
+                                         'Unable to read the .csv file, upload aborted.',
+                                         row=row, csv=self._csv_name, error=str(ex))
+                        return ''
+                    except Exception as ex:
+                        self.events.emit('error', 'Error reading row {row} of {csv} file,\n'
+                                         'error is {error}.\n'
+                                         'Unable to read the .csv file, upload aborted.',
+                                         row=row, csv=self._csv_name, error=str(ex))
+                        return ''
+                row = next(in_file, [])
+        except (OSError, KeyError, zipfile.BadZipFile, ElementTree.ParseError) as ex:
+            self.events.emit('error', 'Error opening {csv}, error is {error}.\n'
+                             'Unable to read the .csv file, upload aborted.',
+                             csv=self._csv_name, error=str(ex))
+            return ''
+        if len(row) > self.DATASET_NAME:
             working_dset = row[self.DATASET_NAME]
         self._dataset_name = working_dset
         return working_dset
 
+    @contextmanager
+    def _manifest_rows(self):
+        '''
+        Open the .csv file, or an .xlsx workbook, for a with statement.
+        Gives an iterator over the rows, each a list of strings.
+        '''
+        if self._csv_name.lower().endswith('.xlsx'):
+            with XlsxRows(self._csv_name) as rows:
+                yield rows
+        else:
+            with open(self._csv_name) as csvfile:
+                yield csv.reader(csvfile, delimiter=',')
+
 
     def _get_csv(self,):
         '''
         Show csv files in current dir and get name of one you want.
         If no csv, prompt for path and file.
         '''
-        list_csv = glob.glob('*.csv')
+        list_csv = glob.glob('*.csv') + glob.glob('*.xlsx')
         list_csv.sort()
         print()
         print('Select a .csv file')
@@ -482,6 +3175,22 @@ class UploadBlackfynn:
         if choice in ('y', 'Y'):
             self._use_agent = True
 
+    def _get_bandwidth(self):
+        '''
+        Shared lab links get saturated by unattended uploads. Let the user
+        cap the bandwidth, possibly only for certain hours.
+        '''
+        print()
+        print('You can limit the upload bandwidth in MB/s, optionally by time of day.')
+        print('For example, 20:00-07:00=0,*=10 is full speed from 8 PM to 7 AM',
+              'and 10 MB/s the rest of the time.')
+        while True:
+            choice = input('Enter a bandwidth schedule, or just Enter for no limit: ')
+            is_ok, errtxt = self.set_bandwidth(choice)
+            if is_ok:
+                break
+            print(errtxt)
+
 
     def _get_prefix(self, level_name):
         '''
@@ -493,58 +3202,165 @@ class UploadBlackfynn:
             prefix = ''
         return prefix
 
-    def _okay_to_update(self, dpkg):
+    def _get_pkg(self, pkg_id):
+        '''
+        Get a datapackage from the site, the package cache calls this.
+        '''
+        return self._b_fynn.get(pkg_id)
+
+    def _okay_to_update(self, dpkg, files=None, rename=None):
         '''
         If we just uploaded a datapackage, it may be UNAVAILABLE.
-        Wait until it is not in that state.
+        Wait until it is not in that state, for as long as ProcessingRates
+        says a package of its type and size should take, with some slack.
+        files are the local files in it, if we know them.
         Return the possibly more current dpkg object.
+        If it takes too long and rename is (prefix, planned name, row), it
+        is put off until the uploads are done, see _finish_deferred, and
+        None is returned.
         '''
         one_tick = 1
-        maxticks = 120 * 60/one_tick  # 2 hours
-        total_ticks = maxticks
         pkg_id = dpkg.id
+        ext, size = self._pkg_size(dpkg, files)
+        guess = self._rates.estimate(ext, size)
+        budget = self._rates.budget(ext, size)
+        start = time.time()
         first_time = True
-        while maxticks:
-            try:
-                dpkg = self._b_fynn.get(pkg_id)   # state may be changing, get current
-                if dpkg.state == 'UNAVAILABLE':
-                    if first_time:
-                        print('Waiting for upload to complete.')
-                        print('For large files, this can take a long time.', flush=True)
-                        first_time = False
-                    maxticks -= 1
-                    time.sleep(one_tick)
-                    so_far = str(timedelta(seconds=total_ticks-maxticks))
-                    if self.overwrite:
-                        self.overwrite('\nWaited {}'.format(so_far))
+        try:
+            while time.time() - start < budget:
+                try:
+                    dpkg = self._pkgs.get(pkg_id)   # state may be changing, get current
+                    if dpkg.state == 'UNAVAILABLE':
+                        if first_time:
+                            self.events.emit('message', 'Waiting for upload to complete.\n'
+                                             'For large files, this can take a long time.')
+                            first_time = False
+                            self._tally('_processing')
+                        if self._cancel.sleep(one_tick):
+                            return dpkg
+                        waited = time.time() - start
+                        if guess is None:
+                            fmt = 'Waited {waited}'
+                        elif waited < guess:
+                            fmt = 'Waited {waited}, about {left} left'
+                        else:
+                            fmt = 'Waited {waited}, expected {expected}'
+                        self.events.emit('waiting', fmt, what='package', id=pkg_id,
+                                         waited=str(timedelta(seconds=int(waited))),
+                                         left=str(timedelta(seconds=int((guess or 0) - waited))),
+                                         expected=str(timedelta(seconds=int(guess or 0))),
+                                         eta=None if guess is None else guess - waited)
                     else:
-                        print('\rWaited {}'.format(so_far), flush=True, end='')
-                else:
-                    print('')
-                    break
-            except Exception as ex:
-                print('Datapackage update error: {}.'.format(str(ex)))
-                print('dpkg state: ', dpkg.state)
-        if maxticks == 0:
-            print('waiting to update timeout, results unpredictable')
-        return dpkg
+                        if not first_time:
+                            self._rates.learn(ext, size, time.time() - start)
+                            self.progress.waited(time.time() - start)
+                        self.events.emit('package_ready', id=pkg_id, name=dpkg.name,
+                                         state=dpkg.state, seconds=time.time() - start)
+                        return dpkg
+                except Exception as ex:
+                    self.events.emit('error', 'Datapackage update error: {error}.\n'
+                                     'dpkg state: {state}', error=str(ex), state=dpkg.state)
+                    self._tally('_retries')
+                    if self._cancel.sleep(one_tick):
+                        return dpkg
+        finally:
+            if not first_time:
+                self._tally('_processing', -1)
 
+        if rename is None:
+            self.events.emit('error', 'waiting to update timeout, results unpredictable')
+            return dpkg
+        self._deferred.append([start, ext, size, dpkg, rename])
+        self.progress.waited(time.time() - start)
+        self._tally('_slow')
+        self.events.emit('message', '{name} is still being processed after {waited}, coming '
+                         'back to it when the uploads are done.', name=dpkg.name, id=pkg_id,
+                         waited=str(timedelta(seconds=int(budget))), deferred=True)
+        return None
 
-    @staticmethod
-    def _wait_for_ready(collection):
+    def _pkg_size(self, dpkg, files):
+        '''
+        The type and size of a package for ProcessingRates, from the local
+        files if we know them, otherwise from its sources, if the site has
+        them yet.
+        '''
+        sizes = []
+        if files:
+            for src in files:
+                try:
+                    sizes.append((src, os.path.getsize(src)))
+                except OSError:
+                    sizes.append((src, 0))
+        else:
+            try:
+                sizes = [(src.s3_key, getattr(src, 'size', None) or 0)
+                         for src in dpkg.sources or []]
+            except Exception:
+                pass
+        return ProcessingRates.kind(sizes)
+
+    def _finish_deferred(self):
+        '''
+        Go back to the packages that took too long to process. Each pass
+        looks at all of them, renames the ones that are done, and gives up
+        on the ones still UNAVAILABLE ProcessingRates.MAX_BUDGET after we
+        started waiting on them.
+        '''
+        if self._deferred:
+            self.events.emit('message', 'Waiting for {left} packages that are taking longer '
+                             'than expected to process.', left=len(self._deferred))
+        while self._deferred and not self._cancel.cancelled:
+            for entry in list(self._deferred):
+                start, ext, size, dpkg, (prefix, planned, row) = entry
+                try:
+                    dpkg = self._pkgs.get(dpkg.id)
+                except Exception as ex:
+                    self.events.emit('error', 'Datapackage update error: {error}.',
+                                     error=str(ex))
+                    self._tally('_retries')
+                    continue
+                if dpkg.state != 'UNAVAILABLE':
+                    self._deferred.remove(entry)
+                    self._rates.learn(ext, size, time.time() - start)
+                    self.events.emit('package_ready', id=dpkg.id, name=dpkg.name,
+                                     state=dpkg.state, seconds=time.time() - start)
+                    self._snap_record(dpkg)
+                    self._pkg_rename(dpkg, prefix, planned, row)
+                elif time.time() - start > ProcessingRates.MAX_BUDGET:
+                    self._deferred.remove(entry)
+                    self._tally('_errors')
+                    self._row_failed(row)
+                    self.events.emit('error', 'ERROR: {name} is still being processed after '
+                                     '{waited}, datapackage not renamed.', name=dpkg.name,
+                                     id=dpkg.id, waited=str(timedelta(
+                                         seconds=ProcessingRates.MAX_BUDGET)))
+            if self._deferred:
+                self.events.emit('waiting', '{left} slow packages left', what='deferred',
+                                 left=len(self._deferred))
+                self._cancel.sleep(1)
+
+
+    def _wait_for_ready(self, collection):
         '''
         Wait for collection to be READY.
         Return current collection object.
+        If we saw it READY a moment ago and have not written to it since,
+        don't bother asking the server again.
         '''
+        if self._ready.is_ready(collection.id):
+            return collection
         maxticks = 30
         while maxticks:
             collection.update()
             if collection.state == 'READY':
+                self._ready.mark_ready(collection.id)
                 break
             else:
-                print('Collection {} not ready, waiting. . .'.format(collection.name))
+                self.events.emit('waiting', 'Collection {name} not ready, waiting. . .',
+                                 what='collection', name=collection.name)
                 maxticks -= 1
-                time.sleep(1)
+                if self._cancel.sleep(1):
+                    break
         return collection
 
 
@@ -559,86 +3375,318 @@ class UploadBlackfynn:
            ds has one file,  result is _ext
            ds has more than one file type, result is _ext1_ext2
         """
-        ret_ext = ''
         if not self._add_ext:
-            return ret_ext
-        for file in dpkg.files:
-            _, ext = os.path.splitext(os.path.basename(file.s3_key))
-            basename = os.path.basename(file.s3_key)
-            if basename == dpkg.name:
+            return ''
+        return self._ext_suffix([os.path.basename(file.s3_key) for file in dpkg.files],
+                                dpkg.name)
+
+    @staticmethod
+    def _ext_suffix(basenames, pkg_name):
+        '''
+        _ext1_ext2 for the extensions of the files, except for a file whose
+        name is the package name, each extension only once.
+        '''
+        exts = []
+        for basename in basenames:
+            if basename == pkg_name:
                 continue
             _, ext = os.path.splitext(basename)
-            if ext not in ret_ext:
-                ret_ext += '_' + ext[1:]
-        return ret_ext
+            if ext and ext[1:] not in exts:
+                exts.append(ext[1:])
+        return ''.join('_' + ext for ext in exts)
+
+    def _predict_name(self, files, prefix):
+        '''
+        Work out what a package will be named once the files are uploaded
+        and renamed, without asking the server. Returns the name and True
+        if it is a protected name that we do not rename.
+        A group of files is named after the first one.
+        '''
+        first = os.path.basename(files[0])
+        stem, ext = os.path.splitext(first)
+        pkg_name = stem if ext.lower() in self.STRIPPED_EXTS else first
+        if first in self.PROTECTED_NAMES or pkg_name in self.PROTECTED_NAMES:
+            return pkg_name, True
+        ext_txt = ''
+        if self._add_ext:
+            ext_txt = self._ext_suffix([os.path.basename(fname) for fname in files], pkg_name)
+        return prefix + pkg_name + ext_txt, False
+
+    def _remote_names(self, dest, skip):
+        '''
+        Names of packages already in the dest collection, according to the
+        snapshot, except for packages holding any of the source files in
+        skip, those are ours.
+        '''
+        if not self._snap:
+            return set()
+        if self._snap_paths is None:
+            self._snap_paths = self._snap.paths()
+        coll_id = self._snap_paths.get(dest)
+        names = set()
+        for pkg_id in self._snap.packages_in(coll_id) if coll_id else ():
+            name, _, _, sources = self._snap.packages[pkg_id]
+            if not any(src[0] in skip for src in sources):
+                names.add(name)
+        return names
+
+    def plan_names(self, rows):
+        '''
+        Work out the final name of every package from the .csv file before
+        anything is uploaded, and fix up names that would collide with each
+        other, or with what is already in the destination collection, so no
+        rename is bound to fail. Files are taken in sorted order so the
+        result does not depend on the order of the rows. The first one to
+        claim a name keeps it. The next gets its file extension(s) tacked on,
+        if it does not already have them, then _2, _3, etc., until the name
+        is unique.
+        Names only collide within a destination, so the destinations are
+        planned one at a time, and only the files going to one of them are
+        held at once.
+        Returns {(destination name, first source file): final package name}
+        for the packages whose names had to be changed, see _planned_name,
+        the number of packages planned, and a list of
+        (source file, wanted name, final name) for the collisions.
+        '''
+        by_dest = OrderedDict()   # dest -> its rows
+        for row in rows:
+            if row.src_file:
+                by_dest.setdefault(row.dest, []).append(row)
+        self._snap_paths = None
+        plan = {}
+        planned = 0
+        collisions = []
+        for dest, dest_rows in by_dest.items():
+            units = sorted((unit.files, unit.row.prefix)
+                           for unit in self._iter_units(dest_rows))
+            dest_name = self._show_dest(dest_rows[0])
+            ours = set(os.path.basename(fname) for files, _ in units for fname in files)
+            taken = self._remote_names(dest, ours)
+            for files, prefix in units:
+                name, protected = self._predict_name(files, prefix)
+                final = name
+                if not protected and final in taken:
+                    ext_txt = self._ext_suffix([os.path.basename(fname) for fname in files], '')
+                    if not final.endswith(ext_txt):
+                        final += ext_txt
+                    base = final
+                    count = 2
+                    while final in taken:
+                        final = '{}_{}'.format(base, count)
+                        count += 1
+                    collisions.append((files[0], name, final))
+                    plan[(dest_name, files[0])] = final
+                taken.add(final)
+                planned += 1
+        return plan, planned, collisions
+
+    def _plan_names(self, rows):
+        '''
+        Make the name plan for the run and tell the user about collisions.
+        '''
+        self._name_plan, planned, collisions = self.plan_names(rows)
+        for fname, name, final in collisions:
+            self.events.emit('message', '{file} would be named {name}, which is already taken, '
+                             'it will be named {final}', file=fname, name=name, final=final)
+        self.events.emit('message', 'Planned {names} package names, {collisions} name '
+                         'collisions fixed', names=planned, collisions=len(collisions))
+
+    def _planned_name(self, dest_name, files):
+        '''
+        The name the name plan gives the package for files uploaded to
+        dest_name, None if it did not have to change it to avoid a
+        collision. Those are named from the name the server gives the
+        package, see _pkg_rename, not from what _predict_name guesses
+        the server will do with the extension.
+        '''
+        return self._name_plan.get((dest_name, files[0]))
+
+    def _show_dest(self, row):
+        '''
+        The destination name we show the user, and key the name plan on.
+        '''
+        return row.dest_name if row.dest else self._dataset.name
+
+    def _name_conform_api(self, res, files, prefix, planned=None):
+        '''
+        Using the api is less work. The res object has lots of info
+        about what we just uploaded, such as datapackage name and id .
+        files are the local files, to know how long processing should take.
+        They come from the row being uploaded.
+        '''
+        for subres in res:
+            pkg_id = subres[0]['package']['content']['id']
+            dpkg = self._pkgs.get(pkg_id)
+            if dpkg.name in self.PROTECTED_NAMES:
+                self._snap_record(dpkg)
+                continue
+            dpkg = self._okay_to_update(dpkg, files,
+                                        (prefix, planned, self._row)) #insure current and updateable
+            if dpkg is None:
+                continue
+            self._snap_record(dpkg)
+            self._pkg_rename(dpkg, prefix, planned, self._row)
+
+
+    def _name_conform_agent(self, files, collection, prefix, planned=None):
+        '''
+        The agent returns no info about what got uploaded. All we can
+        do is find the datapackage with our uploaded file name in the
+        sources attribute. It may take a while for it to show up, so put
+        the files in the pending uploads registry and let the reconcile
+        thread find and rename them while we get on with the uploads.
+        '''
+        fnames = [os.path.basename(file) for file in files]
+        fnames = [fname for fname in fnames if fname not in self.PROTECTED_NAMES]
+        if fnames and self._pending.add(collection, fnames, prefix, planned, self._row):
+            threading.Thread(target=self._reconcile, daemon=True).start()
+
+
+    def _reconcile(self):
+        '''
+        Runs in the background until every pending agent upload has been
+        found and renamed. Each pass looks at the collections we are waiting
+        on, see _reconcile_collection. The sources of a new package are looked
+        up in the registry, so matching a package to its file is a dict lookup.
+        Uploads that are never found are reported, and their rows are not
+        done.
+        '''
+        while not self._pending.finished():
+            if self._cancel.cancelled:
+                for entry in self._pending.expire(0):
+                    self._not_found(entry, 'ERROR: stopped before the uploaded file {file} '
+                                    'was found in {dest}, datapackage not renamed.')
+                self._pending.stopped()
+                return
+            for collection in self._pending.collections():
+                try:
+                    self._reconcile_collection(collection)
+                except Exception as ex:
+                    self.events.emit('error', 'Error looking for uploaded files in {dest}, '
+                                     'error is {error}.', dest=collection.name, error=str(ex))
+            for entry in self._pending.expire():
+                self._not_found(entry, 'ERROR: could not find the uploaded file {file} in '
+                                'a datapackage in {dest}, datapackage not renamed.')
+            self._cancel.sleep(2)
+
+    def _not_found(self, entry, fmt):
+        '''
+        Give up on a pending agent upload, its row is not done.
+        '''
+        self._row_failed(entry[4])
+        self.events.emit('error', fmt, file=', '.join(sorted(entry[5])), dest=entry[1].name)
+
 
-    def _name_conform_api(self, res, prefix):
+    def _reconcile_collection(self, collection):
         '''
-        Using the api is less work. The res object has lots of info
-        about what we just uploaded, such as datapackage name and id .
+        Rename the packages in a collection that hold our pending uploads.
+        The packages that were still being processed are asked for by id.
+        The collection is only listed, to find new packages, when
+        PendingUploads says it is due.
         '''
-        for subres in res:
-            pkg_id = subres[0]['package']['content']['id']
-            dpkg = self._b_fynn.get(pkg_id)
-            if dpkg.name in self.PROTECTED_NAMES:
+        for pkg_id in self._pending.waiting_on(collection.id):
+            try:
+                dpkg = self._get_pkg(pkg_id)
+            except Exception as ex:
+                self.events.emit('error', 'Error getting datapackage {id}, error is {error}.',
+                                 id=pkg_id, error=str(ex))
+                self._pending.seen(collection.id, pkg_id)
                 continue
-            dpkg = self._okay_to_update(dpkg) #insure current and updateable
-            self._pkg_rename(dpkg, prefix)
+            self._pkgs.put(dpkg)
+            self._reconcile_package(collection, dpkg)
+        if not self._pending.due(collection.id):
+            return
+        found = False
+        for dpkg in self._children(collection, 'packages', fresh=True):
+            if self._pending.is_new(collection.id, dpkg.id):
+                found = True
+                self._reconcile_package(collection, dpkg)
+        self._pending.listed(collection.id, found)
+
+    def _reconcile_package(self, collection, dpkg):
+        '''
+        Rename dpkg if it holds one of our pending uploads. A package without
+        sources is still being processed, we look again next pass, without
+        waiting on it.
+        '''
+        if dpkg.state == 'UNAVAILABLE' or not dpkg.sources:
+            self._pending.not_ready(collection.id, dpkg.id)
+            return
+        self._pending.seen(collection.id, dpkg.id)
+        mine = self._pending.match(collection.id, [os.path.basename(lookup.s3_key)
+                                                   for lookup in dpkg.sources])
+        if mine:
+            self._snap_record(dpkg)
+            self._pkg_rename(dpkg, mine[2], mine[3], mine[4])
 
 
-    def _name_conform_agent(self, files, collection, prefix):
+    def _wait_for_pending(self):
         '''
-        The agent returns no info about what got uploaded. All we can
-        do here is get a list of the files in the current collection and
-        find the one with our uploaded file name in the sources attribute.
-        If an item does not have any values in that attribute, it is probably
-        the one we want. We still have to wait until it is not UNAVAILABLE
-        before we can rename it, so wait around for a state we can use.
-        '''
-        collection = self._wait_for_ready(collection)
-        for file in files:
-            file = os.path.basename(file)
-            if file in self.PROTECTED_NAMES:
-                continue
-            dpkg = None
-            for dpkg in collection:
-                if isinstance(dpkg, Collection):
-                    continue
-                if not dpkg.sources: # (this is probably the one we are looking for)
-                    # srcs not valid until pkg is not UNAVAILABLE, wait for it
-                    dpkg = self._okay_to_update(dpkg)
-                for lookup in dpkg.sources:
-                    realfile = os.path.basename(lookup.s3_key)
-                    if realfile == file:
-                        break
-                else:
-                    continue
-                break
-            if dpkg is None:
-                print('ERROR: Unexpected error: could not find the uploaded file'
-                      'in a datapackage, datapackage not renamed.')
-                return
-            self._pkg_rename(dpkg, prefix)
+        Wait for the reconcile thread to finish renaming the agent uploads,
+        then for the packages that took too long to process. Save what we
+        learned about how long processing takes.
+        '''
+        first_time = True
+        while self._pending.count() and not self._cancel.cancelled:
+            if first_time:
+                self.events.emit('message', 'Waiting for Blackfynn to finish processing '
+                                 'the uploaded files.')
+                first_time = False
+            self.events.emit('waiting', '{left} uploads left to rename', what='rename',
+                             left=self._pending.count())
+            self._cancel.sleep(1)
+        self._finish_deferred()
+        try:
+            self._rates.save()
+        except OSError as ex:
+            self.events.emit('error', 'Error saving the processing rates, error is {error}.',
+                             error=str(ex))
+
+
+    def _snap_record(self, dpkg):
+        '''
+        Keep the snapshot, if we have one, up to date with what we upload.
+        '''
+        if self._snap:
+            self._snap.add_package(dpkg.id, dpkg.name, dpkg.parent, dpkg.state,
+                                   DatasetSnapshot.pkg_sources(dpkg))
 
 
-    def _pkg_rename(self, dpkg, prefix):
+    def _pkg_rename(self, dpkg, prefix, planned=None, row=None):
         '''
         Common rename operations regardless of api or agent usage.
+        Use the name from the name plan if there is one. row is the
+        fingerprint of the .csv row the package came from, it is not done
+        if the rename fails.
         '''
-        ext = self._create_ext(dpkg)
-        re_name = prefix + dpkg.name + ext
+        if planned:
+            re_name = planned
+        else:
+            re_name = prefix + dpkg.name + self._create_ext(dpkg)
         if dpkg.name != re_name:
-            print('\nRenaming ', dpkg.name, end='')
-            print(' to', re_name)
-            dpkg = self._okay_to_update(dpkg)
+            old_name = dpkg.name
+            dpkg = self._okay_to_update(dpkg, rename=(prefix, planned, row))
+            if self._cancel.cancelled:
+                self.events.emit('cancelled', 'Stopped, {name} not renamed', name=old_name)
+                return
+            if dpkg is None:
+                return
             try:
                 dpkg.update(name=re_name)
+                self._pkgs.put(dpkg)
+                self._ready.invalidate(dpkg.parent)
+                if self._snap:
+                    self._snap.rename_package(dpkg.id, re_name)
+                self.events.emit('renamed', 'Renamed {old} to {new}', old=old_name, new=re_name,
+                                 id=dpkg.id)
             except Exception as ex:
-                print('Datapackage update error: {}.'.format(str(ex)))
+                self._row_failed(row)
+                self.events.emit('error', 'Error renaming {old} to {new}, datapackage update '
+                                 'error: {error}.', old=old_name, new=re_name, error=str(ex))
         else:
-            print(dpkg.name, 'not renamed')
+            self.events.emit('message', '{name} not renamed', name=dpkg.name)
 
-    def name_conform(self, res, files, collection, prefix):
+    def name_conform(self, res, files, collection, prefix, planned=None):
         '''
         File(s) have been uploaded. The upload results is in res if using API,
         in files list if using agent. Make the datapackage name conform to the
@@ -652,11 +3700,13 @@ class UploadBlackfynn:
         TODO when more than one file winds up in a dpkg, it makes sense to concatenate
         the extensions if there are only a couple of file, like:
         sub-name_name_ext1_ext2. This can get out of hand with 50 files.
+
+        planned is the name from the name plan, see plan_names.
         '''
         if res:
-            self._name_conform_api(res, prefix)
+            self._name_conform_api(res, files, prefix, planned)
         else:
-            self._name_conform_agent(files, collection, prefix)
+            self._name_conform_agent(files, collection, prefix, planned)
 
 
     def validate_profile(self):
@@ -666,6 +3716,7 @@ class UploadBlackfynn:
         ret = True
         prob = ''
         try:
+            load_sdk()
             self._b_fynn = Blackfynn(self._profile_name)
         except Exception as ex:
             ret = False
@@ -687,6 +3738,61 @@ class UploadBlackfynn:
             ret = False
         return ret, prob
 
+    def preflight(self, check_files=True):
+        '''
+        Get ready to upload: check that the files in the .csv file exist,
+        log in with the profile and connect to the dataset. The file check
+        waits on the file system and the others on the site, so they run at
+        the same time, and each is reported with a 'preflight' event, with
+        how long it took, as soon as it is done. Connecting to the dataset
+        needs the login, so those two go one after the other.
+        Returns {'files': True if they all exist, 'profile': (okay, error),
+        'dataset': (okay, error)}, without 'files' if check_files is False.
+        '''
+        results = {}
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(self._preflight_site, results)]
+            if check_files:
+                futures.append(pool.submit(self._preflight_step, results, 'files',
+                                           self.chk_files_exist))
+            while wait(futures, timeout=0.1)[1]:
+                if self.idle:
+                    self.idle()
+            for future in futures:
+                future.result()
+        seconds = time.time() - start
+        times = dict((step, took) for step, (_, took) in results.items())
+        slowest = max(times, key=times.get)
+        self.events.emit('preflight', 'Checks done in {seconds:.2f} seconds, the {slowest} '
+                         'took the longest', step='all', seconds=seconds, slowest=slowest,
+                         times=times)
+        return dict((step, result) for step, (result, _) in results.items())
+
+    def _preflight_site(self, results):
+        '''
+        Log in, then connect to the dataset if that worked.
+        '''
+        okay, _ = self._preflight_step(results, 'profile', self.validate_profile)
+        if okay:
+            self._preflight_step(results, 'dataset', self.bf_connect)
+        else:
+            results['dataset'] = ((False, 'Not connected, the profile did not work.'), 0.0)
+
+    def _preflight_step(self, results, step, func):
+        '''
+        Run one preflight step, time it and tell the sinks how it went.
+        '''
+        began = time.time()
+        result = func()
+        seconds = time.time() - began
+        results[step] = (result, seconds)
+        okay, error = result if isinstance(result, tuple) else (result, '')
+        self.events.emit('preflight', 'Checked {step}: {status} in {seconds:.2f} seconds',
+                         step=step, okay=okay, error=error, seconds=seconds,
+                         status='okay' if okay else 'FAILED')
+        return okay, error
+
     @classmethod
     def get_version(cls):
         """
@@ -701,34 +3807,40 @@ class UploadBlackfynn:
         Does not return on fatal errors.
         '''
         # CSV File
-        self._get_csv()
+        if not self._csv_name:
+            self._get_csv()
         if not self._csv_name:
             sys.exit('Uploading aborted.')
-        if not self.chk_files_exist():
-            choice = input('\nSome files are missing.\n'
-                           'Do you want to continue anyway?\n'
-                           'Type y for yes, anything else for no: ')
-            if choice != 'y':
-                sys.exit('Uploading aborted.')
         # Profile
-        self.get_profile()
-        is_ok, errtxt = self.validate_profile()
-        if not is_ok:
-            sys.exit('Bad profile or error trying to connect to ' +
-                     'Blackfynn, uploading aborted.\n' + errtxt)
+        if not self._profile_name:
+            self.get_profile()
         # Dataset
         self._get_dataset_name()
         if not self._dataset_name:
             sys.exit('There is not a dataset name in the .csv file in row 4, column 1,\n'
                      'cannot upload, aborting program.')
+        # Check the files, log in and connect to the dataset, all at once
+        print('Checking files and trying to connect to dataset. . .', flush=True)
+        ready = self.preflight()
+        is_ok, errtxt = ready['profile']
+        if not is_ok:
+            sys.exit('Bad profile or error trying to connect to ' +
+                     'Blackfynn, uploading aborted.\n' + errtxt)
+        is_ok, errtxt = ready['dataset']
+        if not is_ok:
+            sys.exit('Unable to connect to the dataset, uploading aborted. ' + errtxt)
+        if not ready['files']:
+            choice = input('\nSome files are missing.\n'
+                           'Do you want to continue anyway?\n'
+                           'Type y for yes, anything else for no: ')
+            if choice != 'y':
+                sys.exit('Uploading aborted.')
         # Tag on file extension that BF removes for known file types?
         self._get_add_ext()
         # Use the blackyfynn agent?
         self._get_use_agent()
-        print('Trying to connect to dataset. . .', flush=True)
-        is_ok, errtxt = self.bf_connect()
-        if not is_ok:
-            sys.exit('Unable to connect to the dataset, uploading aborted. ' + errtxt)
+        # Limit bandwidth?
+        self._get_bandwidth()
         print()
         print('Dataset:        {}\nCSV file:       {}\nProfile:        {}\n'\
                'Add Extension:  '.format(
@@ -742,97 +3854,827 @@ class UploadBlackfynn:
             print('Yes')
         else:
             print('No')
+        print('Bandwidth:      {}'.format(self._throttle.schedule.spec or 'No limit'))
 
         ok2go = input('Okay to continue(y/n)? ')
         if ok2go != 'y':
             sys.exit('Aborting upload.')
 
+    def connect(self):
+        '''
+        Connect to the dataset for the commands that work on the dataset
+        without uploading. The .csv file gives us the dataset name.
+        Prompts for the .csv file and profile if they were not given on
+        the command line. Does not return on fatal errors.
+        '''
+        if not self._csv_name:
+            self._get_csv()
+        if not self._csv_name:
+            sys.exit('Aborted.')
+        self._get_dataset_name()
+        if not self._dataset_name:
+            sys.exit('There is not a dataset name in the .csv file in row 4, column 1,\n'
+                     'aborting program.')
+        if not self._profile_name:
+            self.get_profile()
+        is_ok, errtxt = self.validate_profile()
+        if not is_ok:
+            sys.exit('Bad profile or error trying to connect to Blackfynn.\n' + errtxt)
+        print('Trying to connect to dataset {}. . .'.format(self._dataset_name), flush=True)
+        is_ok, errtxt = self.bf_connect()
+        if not is_ok:
+            sys.exit('Unable to connect to the dataset. ' + errtxt)
+
     def cancel_upload(self):
         """
         The gui program can abort the upload, not so easy from cmd line (could check for
         Q keypress in the upload loop, I guess
         """
-        self._stop_right_now = True
+        self._cancel.cancel()
 
-    def do_upload(self):
+    def take_snapshot(self):
         '''
-        Read in a csv file with from and to info and upload
-        to the selected dataset on the Blackfynn site.
-        Create collections (subfolders) as required
-        and rename data packages (files) as required.
+        Walk the whole dataset and save a snapshot of it to disk,
+        so later runs start out knowing what is on the site.
+        '''
+        self.events.emit('message', 'Taking a snapshot of dataset {dataset}. . .',
+                         dataset=self._dataset.name)
+        start = time.time()
+        snap = DatasetSnapshot()
+        try:
+            snap.take(self._dataset)
+        except Exception as ex:
+            self.events.emit('error', 'Error walking the dataset, error is {error}.',
+                             error=str(ex))
+            return False
+        path = DatasetSnapshot.default_path(self._dataset.id)
+        snap.save(path)
+        self.events.emit('message', '{collections} collections and {packages} packages saved '
+                         'to {path}\nElapsed time: {elapsed}', collections=len(snap.collections),
+                         packages=len(snap.packages), path=path,
+                         elapsed=str(timedelta(seconds=time.time()-start)))
+        return True
+
+
+    @staticmethod
+    def _file_checksum(path, chunk_size=None):
+        '''
+        The md5 of a local file, or with chunk_size, the md5 of the md5s of
+        its chunks, the way multipart uploads are checked.
+        '''
+        with SequentialReader(path, chunk_size or SequentialReader.CHUNK) as reader:
+            if not chunk_size or reader.size <= chunk_size:
+                digest = hashlib.md5()
+                for chunk in reader.chunks():
+                    digest.update(chunk)
+                return digest.hexdigest()
+            parts = hashlib.md5()
+            for chunk in reader.chunks():
+                parts.update(hashlib.md5(chunk).digest())
+            return parts.hexdigest()
+
+
+    def audit(self, checksums=False):
+        '''
+        Check that every file in the .csv file made it to the dataset,
+        without downloading anything. The whole dataset is listed, in
+        parallel, and joined with the files in the .csv file on the
+        destination folder and file name. Reports files that are missing,
+        uploaded more than once, a different size (or checksum, if asked
+        for and the site has one) than the local file, or in a package
+        that failed processing, and files in the destination folders that
+        are not in the .csv file. Returns True if there were no problems.
+        '''
+        self.events.emit('message', 'Auditing dataset {dataset} against {csv}. . .',
+                         dataset=self._dataset.name, csv=self._csv_name)
+        start = time.time()
+        snap = DatasetSnapshot()
+        try:
+            snap.take(self._dataset)
+        except Exception as ex:
+            self.events.emit('error', 'Error listing the dataset, error is {error}.',
+                             error=str(ex))
+            return False
+        remote = {}     # (collection path, source name) -> [(package id, size, checksum, state)]
+        for pkg_id, (_, parent_id, state, sources) in snap.packages.items():
+            path = snap.path_of(parent_id)
+            for src in sources:
+                remote.setdefault((path, src[0]), []).append(
+                    (pkg_id, src[1], src[2] if len(src) > 2 else None, state))
+        counts = dict.fromkeys(('missing', 'duplicate', 'size', 'checksum', 'state', 'extra'), 0)
+
+        def _report(problem, fmt, **data):
+            counts[problem] += 1
+            self.events.emit('audit', fmt, problem=problem, **data)
+
+        dests = set()
+        matched = set()     # the remote keys files in the .csv file were found under
+        checked = 0
+        for unit in self._iter_units(self._read_rows()):
+            row, files = unit.row, unit.files
+            dests.add(row.dest)
+            dest_name = self._show_dest(row)
+            for fname in files:
+                key = (row.dest, os.path.basename(fname))
+                found = remote.get(key)
+                checked += 1
+                if not found:
+                    _report('missing', 'MISSING  {file} is not in {dest}', file=fname,
+                            dest=dest_name)
+                    continue
+                if key in matched:
+                    continue    # listed more than once in the .csv file, already checked
+                matched.add(key)
+                if len(found) > 1:
+                    _report('duplicate', 'TWICE    {file} is in {count} packages in {dest}',
+                            file=fname, count=len(found), dest=dest_name)
+                pkg_id, size, checksum, state = found[0]
+                if state == 'ERROR':
+                    _report('state', 'ERROR    {file} is in a package that failed processing',
+                            file=fname, id=pkg_id)
+                local_size = os.path.getsize(fname)
+                if size is not None and size != local_size:
+                    _report('size', 'SIZE     {file} is {local} bytes here, {remote} on the site',
+                            file=fname, local=local_size, remote=size, id=pkg_id)
+                elif checksums and checksum:
+                    local_sum = self._file_checksum(fname, checksum[1])
+                    if local_sum != checksum[0]:
+                        _report('checksum', 'CHECKSUM {file} is {local} here, {remote} on the '
+                                'site', file=fname, local=local_sum, remote=checksum[0],
+                                id=pkg_id)
+        for (path, name), found in sorted(remote.items()):
+            if path in dests and (path, name) not in matched:
+                for pkg_id, _, _, _ in found:
+                    _report('extra', 'EXTRA    {file} in {dest} is not in the .csv file',
+                            file=name, dest='/'.join(path) or self._dataset.name, id=pkg_id)
+        problems = sum(counts.values())
+        self.events.emit('summary', 'Audited {checked} files against {packages} packages in '
+                         '{seconds:.1f} seconds: {missing} missing, {duplicate} uploaded more '
+                         'than once, {size} different size, {checksum} different checksum, '
+                         '{state} failed processing, {extra} extra', checked=checked,
+                         packages=len(snap.packages), seconds=time.time()-start,
+                         problems=problems, **counts)
+        return problems == 0
+
+
+    def _load_snapshot(self):
+        '''
+        Load the saved snapshot of the dataset, if there is one, and bring
+        it up to date.
+        '''
+        self._snap = None
+        if not self._use_snapshot:
+            return
+        if self._batch_snaps is not None and self._dataset.id in self._batch_snaps:
+            # an earlier manifest in this batch loaded it and kept it current
+            self._snap = self._batch_snaps[self._dataset.id]
+            return
+        start = time.time()
+        snap = DatasetSnapshot.load(DatasetSnapshot.default_path(self._dataset.id))
+        if snap is None:
+            return
+        self.events.emit('message', 'Loaded snapshot of {collections} collections and '
+                         '{packages} packages in {seconds:.3f} seconds',
+                         collections=len(snap.collections), packages=len(snap.packages),
+                         seconds=time.time()-start)
+        start = time.time()
+        try:
+            changed = snap.revalidate(self._b_fynn)
+        except Exception as ex:
+            self.events.emit('error', 'Error checking the snapshot, not using it. '
+                             'Error is {error}.', error=str(ex))
+            return
+        self.events.emit('message', '{changed} collections changed since the snapshot was '
+                         'taken, checked in {seconds:.1f} seconds', changed=changed,
+                         seconds=time.time()-start)
+        self._snap = snap
+        if self._batch_snaps is not None:
+            self._batch_snaps[self._dataset.id] = snap
+
+
+    def _save_snapshot(self):
+        '''
+        Save the snapshot with what we did this run.
+        '''
+        if self._snap:
+            try:
+                self._snap.save(DatasetSnapshot.default_path(self._dataset.id))
+            except OSError as ex:
+                self.events.emit('error', 'Error saving the snapshot, error is {error}.',
+                                 error=str(ex))
+
+
+    def _walk_rows(self, in_file):
+        '''
+        Walk the rows of the .csv file after the info rows. The top level,
+        subject, session and destination folder are carried down from
+        earlier rows, so fill them in and yield a RowDest for each row.
         '''
         top_level_name = ''
-        curr_data_dir = self._dataset
-        dest_name = self._dataset.name
-        curr_top_dir = []
-        curr_sub_dir = []
-        curr_sess_dir = []
+        dest_name = self._dataset_name
+        dest = top_dest = sub_dest = sess_dest = ()
         upload_prefix = ''
         curr_sub_name = ''
         curr_sess_name = ''
-        self._uploaded = 0
+        dests = {}   # so the rows going to one place share one dest tuple
+        for row in in_file:
+            row = row + [''] * (self.SRCFILE + 1 - len(row))  # short rows
+            top_name = row[self.TOP_LEVEL]
+            sub_name = row[self.SUBJ]
+            sess_name = row[self.SESSID]
+            dest_fold = row[self.DESTFOLD]
+            # Step down into top level, subject, sample, etc.
+            if top_name and not top_name.isspace():
+                top_level_name = top_name
+                top_dest = sub_dest = tuple(top_name.split('/'))
+                sess_dest = ()
+                dest = top_dest
+                dest_name = top_level_name
+                curr_sub_name = ''
+                curr_sess_name = ''
+            # Step down into instance of a subject, sample, etc.
+            if sub_name and not sub_name.isspace():
+                curr_sub_name = self._get_prefix(top_level_name) + sub_name
+                dest_name = top_level_name + '/' + curr_sub_name
+                sub_dest = top_dest + (curr_sub_name,)
+                dest = sub_dest
+                upload_prefix = curr_sub_name + '_'
+                sess_dest = ()
+                curr_sess_name = ''
+            # Step down into optional session
+            if sess_name and not sess_name.isspace():
+                curr_sess_name = self._get_prefix('session') + sess_name
+                dest_name = top_level_name + '/' + curr_sub_name + '/' + curr_sess_name
+                sess_dest = sub_dest + (curr_sess_name,)
+                dest = sess_dest
+                upload_prefix = curr_sub_name + '_' + curr_sess_name + '_'
+            # Step down into data type, anat, ephys, etc., under subject/sample/etc/dir
+            if dest_fold and not dest_fold.isspace():
+                dest = (sess_dest or sub_dest) + tuple(dest_fold.split('/'))
+                dest_name = top_level_name + '/' + curr_sub_name
+                if curr_sess_name:
+                    dest_name += '/' + curr_sess_name
+                dest_name += '/' + dest_fold
+            dest = dests.setdefault(dest, tuple(sys.intern(part) for part in dest))
+            yield RowDest(dest, sys.intern(upload_prefix), sys.intern(dest_name),
+                          row[self.SRCFILE])
+
 
-        print('Reading file {}'.format(self._csv_name))
-        with open(self._csv_name) as csvfile:
-            in_file = csv.reader(csvfile, delimiter=',')
+    def _read_rows(self):
+        '''
+        Read the .csv file and return the RowDest for every row.
+        '''
+        with self._manifest_rows() as in_file:
             try:
                 for row in range(self.ROWS_TO_DSET):  # skip info rows
                     next(in_file)
             except Exception as ex:
-                print('Error reading row {} of {} file,\n'
-                      'error is {}.'.format(row, self._csv_name, str(ex)))
-                print('If you are using excel, save the file as a CSV (MS-DOS) .csv file')
-            for row in in_file:
-                top_name = row[self.TOP_LEVEL]
-                sub_name = row[self.SUBJ]
-                sess_name = row[self.SESSID]
-                dest_fold = row[self.DESTFOLD]
-                src_file = row[self.SRCFILE]
-                # Step down into top level, subject, sample, etc.
-                if top_name and not top_name.isspace():
-                    top_level_name = top_name
-                    curr_data_dir = self._collection_chk(self._dataset, top_level_name)
-                    curr_top_dir = curr_data_dir
-                    dest_name = top_level_name
-                    curr_sub_name = ''
-                    curr_sess_name = ''
-                # Step down into instance of a subject, sample, etc.
-                if sub_name and not sub_name.isspace():
-                    curr_sub_name = self._get_prefix(top_level_name) + sub_name
-                    dest_name = top_level_name + '/' + curr_sub_name
-                    curr_data_dir = self._collection_chk(curr_top_dir, curr_sub_name)
-                    curr_sub_dir = curr_data_dir
-                    upload_prefix = curr_sub_name + '_'
-                    curr_sess_dir = []
-                    curr_sess_name = ''
-                # Step down into optional session
-                if sess_name and not sess_name.isspace():
-                    curr_sess_name = self._get_prefix('session') + sess_name
-                    dest_name = top_level_name + '/' + curr_sub_name + '/' + curr_sess_name
-                    curr_data_dir = self._collection_chk(curr_sub_dir, curr_sess_name)
-                    curr_sess_dir = curr_data_dir
-                    upload_prefix = curr_sub_name + '_' + curr_sess_name + '_'
-                # Step down into data type, anat, ephys, etc., under subject/sample/etc/dir
-                if dest_fold and not dest_fold.isspace():
-                    if isinstance(curr_sess_dir, Collection):
-                        curr_data_dir = self._collection_chk(curr_sess_dir, dest_fold)
-                    else:
-                        curr_data_dir = self._collection_chk(curr_sub_dir, dest_fold)
-                    dest_name = top_level_name + '/' + curr_sub_name
-                    if curr_sess_name:
-                        dest_name += '/' + curr_sess_name
-                    dest_name += '/' + dest_fold
-                if not src_file:
+                self.events.emit('error', 'Error reading row {row} of {csv} file,\n'
+                                 'error is {error}.\n'
+                                 'If you are using excel, save the file as a CSV (MS-DOS) '
+                                 '.csv file, or use the .xlsx file', row=row,
+                                 csv=self._csv_name, error=str(ex))
+            return list(self._walk_rows(in_file))
+
+
+    def _iter_units(self, rows):
+        '''
+        Expand the file entries in the rows into upload units, the same way
+        _upload_list does. Yields a PlanUnit for each. A single file is a
+        unit by itself, files in a [] group are uploaded together. Only one
+        row is expanded at a time.
+        '''
+        for row in rows:
+            if not row.src_file:
+                continue
+            for file_list in self._make_file_list(row.src_file):
+                if isinstance(file_list[0], str):
+                    for fname in file_list:
+                        yield PlanUnit(row, (fname,), False)
+                elif isinstance(file_list[0], list):
+                    yield PlanUnit(row, tuple(file for fn in file_list for file in fn), True)
+
+
+    def _pkg_conforms(self, pkg_id, prefix, planned):
+        '''
+        Does the package name follow the naming convention?
+        If there is a planned name, it has to be that.
+        '''
+        name = self._snap.packages[pkg_id][0]
+        if planned:
+            return name == planned
+        return not prefix or name in self.PROTECTED_NAMES or name.startswith(prefix)
+
+
+    def plan_sync(self):
+        '''
+        Compare the .csv file with the snapshot of the dataset in one pass
+        and return the list of SyncActions it takes to make the dataset
+        match: collections to create, new files to upload, changed files
+        (the size is different) to replace, packages to rename so they follow
+        the naming conventions, and, if asked for, packages that are not in
+        the .csv file to delete.
+        '''
+        rows = self._read_rows()
+        self._plan_names(rows)
+        remote = self._snap.paths()
+        actions = []
+        made = set()
+        wanted = {}   # collection id -> set of source names in the .csv file
+        for unit in self._iter_units(rows):
+            row, files = unit.row, unit.files
+            coll_id = remote.get(row.dest)
+            if coll_id is None:
+                for depth in range(1, len(row.dest) + 1):
+                    if row.dest[:depth] not in remote and row.dest[:depth] not in made:
+                        made.add(row.dest[:depth])
+                        actions.append(SyncAction('mkdir', row.dest[:depth], '', '', (), ()))
+                actions.append(SyncAction('upload', row.dest, row.dest_name, row.prefix,
+                                          files, ()))
+                continue
+            names = [os.path.basename(fname) for fname in files]
+            wanted.setdefault(coll_id, set()).update(names)
+            pkg_ids = [self._snap.package_for(coll_id, name) for name in names]
+            if not any(pkg_ids):
+                actions.append(SyncAction('upload', row.dest, row.dest_name, row.prefix,
+                                          files, ()))
+                continue
+            changed = False
+            for fname, name, pkg_id in zip(files, names, pkg_ids):
+                remote_size = self._snap.source_size(pkg_id, name) if pkg_id else None
+                if pkg_id is None or (remote_size is not None and
+                                      remote_size != os.path.getsize(fname)):
+                    changed = True
+            pkg_ids = tuple(sorted(set(pkg_id for pkg_id in pkg_ids if pkg_id)))
+            if changed:
+                actions.append(SyncAction('replace', row.dest, row.dest_name, row.prefix,
+                                          files, pkg_ids))
+                continue
+            planned = self._planned_name(self._show_dest(row), files)
+            for pkg_id in pkg_ids:
+                if not self._pkg_conforms(pkg_id, row.prefix, planned):
+                    actions.append(SyncAction('rename', row.dest, row.dest_name, row.prefix,
+                                              files, (pkg_id,)))
+        if self._delete_orphans:
+            for coll_id, names in wanted.items():
+                for pkg_id in self._snap.packages_in(coll_id):
+                    sources = set(src[0] for src in self._snap.packages[pkg_id][3])
+                    if not sources & names:
+                        actions.append(SyncAction('delete', self._snap.path_of(coll_id), '', '',
+                                                  (), (pkg_id,)))
+        return actions
+
+
+    def _delete_pkgs(self, act):
+        '''
+        Delete the packages of a replace or delete SyncAction.
+        Returns False if we could not.
+        '''
+        for pkg_id in act.pkg_ids:
+            name, parent_id = self._snap.packages[pkg_id][:2]
+            dest_name = '/'.join(act.dest) or self._dataset.name
+            try:
+                self._pkgs.get(pkg_id).delete()
+                self._pkgs.invalidate(pkg_id)
+            except Exception as ex:
+                self.events.emit('error', 'Error deleting package {name}, error is {error}.',
+                                 name=name, error=str(ex))
+                return False
+            self.events.emit('deleted', 'Deleted {name} from {dest}', name=name,
+                             dest=dest_name, id=pkg_id)
+            self._snap.drop_package(pkg_id)
+            self._ready.invalidate(parent_id)
+        return True
+
+
+    def _do_sync(self):
+        '''
+        Work out what it takes to make the dataset match the .csv file
+        and do only that.
+        '''
+        if not self._snap:
+            self.events.emit('message', 'No snapshot of the dataset, taking one. . .')
+            self._snap = DatasetSnapshot()
+            self._snap.take(self._dataset)
+        start = time.time()
+        actions = self.plan_sync()
+        counts = {}
+        for act in actions:
+            counts[act.kind] = counts.get(act.kind, 0) + 1
+        self.events.emit('message', 'Sync plan made in {seconds:.1f} seconds: {mkdir} '
+                         'collections to create, {upload} uploads, {replace} replacements, '
+                         '{rename} renames, {delete} deletes', seconds=time.time()-start,
+                         **{kind: counts.get(kind, 0)
+                            for kind in ('mkdir', 'upload', 'replace', 'rename', 'delete')})
+        self._precreate_tree([act.dest for act in actions if act.kind == 'mkdir'])
+        sends = [src for act in actions if act.kind in ('upload', 'replace')
+                 for src in act.files]
+        self.progress.reset(self._file_bytes(sends), len(sends))
+        self._start_staging(sends)
+        for act in actions:
+            if self._cancel.cancelled:
+                return False
+            if act.kind in ('replace', 'delete') and not self._delete_pkgs(act):
+                if act.kind == 'replace':
+                    self._skip_files(act.files)
+                continue
+            if act.kind in ('upload', 'replace'):
+                collection = self._resolve_dest(act.dest)
+                if collection is None:
+                    self.events.emit('skipped', 'Cannot get to {dest}, skipping {files}',
+                                     dest=act.dest_name, files=act.files)
+                    self.progress.skip(self._file_bytes(act.files), len(act.files))
+                    continue
+                dest_name = act.dest_name if act.dest else self._dataset.name
+                files = [[list(act.files)]] if len(act.files) > 1 else [list(act.files)]
+                self._upload_list(collection, files, act.prefix, dest_name)
+            elif act.kind == 'rename':
+                try:
+                    dest_name = act.dest_name if act.dest else self._dataset.name
+                    self._pkg_rename(self._pkgs.get(act.pkg_ids[0]), act.prefix,
+                                     self._planned_name(dest_name, act.files))
+                except Exception as ex:
+                    self.events.emit('error', 'Error renaming package, error is {error}.',
+                                     error=str(ex))
+        return True
+
+
+    def do_upload(self):
+        '''
+        Read in a csv file with from and to info and upload
+        to the selected dataset on the Blackfynn site.
+        Create collections (subfolders) as required
+        and rename data packages (files) as required.
+        The collections are created ahead of the uploads in the background.
+        '''
+        with self._expanding():
+            return self._do_upload()
+
+    def _reset_caches(self):
+        '''
+        Forget which collections we found, created and saw READY, and what
+        was in them, they may have been deleted or changed on the site since.
+        Each run starts this way, except in a batch, which does it once at
+        its start and keeps them for all of its .csv files. Our own
+        uploads, renames and new collections keep them current.
+        '''
+        self._ready = ReadyCache()
+        self._coll_flight = SingleFlight()
+        self._listed = {}
+
+    def _do_upload(self):
+        '''
+        The upload itself, see do_upload.
+        '''
+        self._uploaded = 0
+        self._retries = 0
+        self._errors = 0
+        self._sent_bytes = 0
+        if self._batch_snaps is None:
+            self._reset_caches()
+        self._pkgs.saved = 0
+        self._lister.pages = self._lister.paged = self._lister.unpaged = 0
+        self._pending = PendingUploads()
+        self._deferred = []
+        self._slow = 0
+        self._row = None
+        self._failed_rows = set()
+
+        self._load_snapshot()
+        if self._sync:
+            finished = self._do_sync()
+            self._wait_for_pending()
+            self._stop_staging()
+            self._save_snapshot()
+            self._cancel.reset()
+            self._run_summary()
+            return finished
+        ledger = RowLedger(RowLedger.default_path(self._dataset.id), self._csv_name)
+        todo, current = self._plan_rows(ledger)
+        precreate = threading.Thread(target=self._precreate_tree,
+                                     args=(set(row.dest for _, row, _ in todo),), daemon=True)
+        precreate.start()
+        self._start_staging(src for unit in self._iter_units(row for _, row, _ in todo)
+                            for src in unit.files)
+        finished = True
+        uploaded = []
+        for idx, row, fprint in todo:
+            curr_data_dir = self._resolve_dest(row.dest)
+            if not row.src_file:
+                if curr_data_dir is not None:
+                    ledger.add(fprint)
+                continue
+            if curr_data_dir is None:
+                self.events.emit('skipped', 'Cannot get to {dest}, skipping {files}',
+                                 dest=row.dest_name, files=row.src_file)
+                files = list(self._flat_files(self._make_file_list(row.src_file)))
+                self.progress.skip(self._file_bytes(files), len(files))
+                continue
+            self.events.emit('row_started', row=idx, dest=row.dest_name, files=row.src_file)
+            dest_name = self._show_dest(row)
+            expanded_files = self._make_file_list(row.src_file)
+            if expanded_files:
+                self._row = fprint
+                self._upload_list(curr_data_dir, expanded_files, row.prefix, dest_name)
+                if self._cancel.cancelled:
+                    finished = False
+                    break
+                uploaded.append(fprint)
+        self._row = None
+        precreate.join()
+        if finished:
+            self._wait_for_pending()
+        # a row is done once its files are sent and renamed
+        unsettled = (self._failed_rows | self._pending.rows() |
+                     set(entry[4][2] for entry in self._deferred))
+        for fprint in uploaded:
+            if fprint not in unsettled:
+                ledger.add(fprint)
+        self._save_ledger(ledger, current)
+        if not finished:
+            self._stop_staging()
+            self._save_snapshot()
+            self._cancel.reset()
+            return False
+        self._stop_staging()
+        self._save_snapshot()
+        self._run_summary()
+        return True
+
+
+    def _plan_rows(self, ledger):
+        '''
+        Read the .csv file, plan the package names, and work out which rows
+        to do, see _rows_to_do, which this returns.
+        '''
+        self.events.emit('message', 'Reading file {csv}', csv=self._csv_name)
+        rows = self._read_rows()
+        self._plan_names(rows)
+        return self._rows_to_do(rows, ledger)
+
+    @staticmethod
+    def _flat_files(expanded):
+        '''
+        All of the file names in a _make_file_list list.
+        '''
+        for file_list in expanded:
+            if isinstance(file_list[0], str):
+                yield from file_list
+            else:
+                for group in file_list:
+                    yield from group
+
+
+    def _rows_to_do(self, rows, ledger):
+        '''
+        The rows that are new or have changed since the last run, or all of
+        them if set_full was called, as (row number, row, fingerprint). Also
+        returns the fingerprints of all the rows. The file entries are
+        expanded one row at a time, see _make_file_list for which are kept.
+        Starts self.progress over with the bytes in the rows to do.
+        '''
+        todo = []
+        current = set()
+        nbytes = nfiles = 0
+        for idx, row in enumerate(rows):
+            expanded = self._make_file_list(row.src_file) if row.src_file else []
+            fprint = ledger.fingerprint(row, self._flat_files(expanded), self._add_ext)
+            current.add(fprint)
+            if self._full or not ledger.has(fprint):
+                todo.append((idx, row, fprint))
+                files = list(self._flat_files(expanded))
+                nbytes += self._file_bytes(files)
+                nfiles += len(files)
+        self.progress.reset(nbytes, nfiles)
+        if len(todo) < len(rows):
+            self.events.emit('message', '{unchanged} of {rows} rows are unchanged since they '
+                             'were uploaded, skipping them', unchanged=len(rows) - len(todo),
+                             rows=len(rows))
+        return todo, current
+
+
+    def _save_ledger(self, ledger, current):
+        '''
+        Remember which rows are done.
+        '''
+        try:
+            ledger.save(current)
+        except OSError as ex:
+            self.events.emit('error', 'Error saving the row fingerprints, error is {error}.',
+                             error=str(ex))
+
+
+    def run_batch(self, csv_files):
+        '''
+        Upload the files in several .csv files, one after the other, without
+        asking anything. The profile and the other settings must already be
+        set. The connection to Blackfynn, the datasets, the package and
+        collection caches and the snapshots are shared by all of them, and
+        since they all go through this one object, so are the bandwidth
+        limit and the other limits. A .csv file that cannot be used is
+        skipped. Returns True if every .csv file was done.
+        '''
+        datasets = {}
+        results = []
+        self._batch_snaps = {}
+        self._reset_caches()
+        start = time.time()
+        try:
+            for csv_name in csv_files:
+                self.events.emit('message', '\n*** {csv} ***', csv=csv_name)
+                result = {'csv': csv_name, 'dataset': '', 'uploaded': 0, 'bytes': 0,
+                          'seconds': 0.0, 'errors': 0, 'done': False}
+                results.append(result)
+                self.set_csv(csv_name)
+                result['dataset'] = self._dataset_name
+                if not self._dataset_name:
+                    self.events.emit('error', 'No dataset name in {csv}, skipping it.',
+                                     csv=csv_name)
+                    continue
+                if not self.chk_files_exist():
+                    self.events.emit('error', 'Files listed in {csv} are missing, skipping it.',
+                                     csv=csv_name)
+                    continue
+                if self._dataset_name not in datasets:
+                    is_ok, errtxt = self.bf_connect()
+                    if not is_ok:
+                        self.events.emit('error', 'Unable to connect to dataset {dataset}, '
+                                         'skipping {csv}. {error}', dataset=self._dataset_name,
+                                         csv=csv_name, error=errtxt)
+                        continue
+                    datasets[self._dataset_name] = self._dataset
+                self._dataset = datasets[self._dataset_name]
+                began = time.time()
+                finished = self.do_upload()
+                result.update(uploaded=self._uploaded, bytes=self._sent_bytes,
+                              seconds=time.time()-began, errors=self._errors, done=finished)
+                if not finished:
+                    break
+        finally:
+            self._batch_snaps = None
+        self._batch_summary(results, time.time()-start)
+        return len(results) == len(csv_files) and all(res['done'] for res in results)
+
+
+    def _batch_summary(self, results, seconds):
+        '''
+        One summary for the whole batch.
+        '''
+        lines = ['', 'Batch of {} .csv files:'.format(len(results))]
+        for res in results:
+            lines.append('  {:<30} {:<20} {:>6} files {:>10.1f} MB {:>8.1f} s  {}'.format(
+                os.path.basename(res['csv']), res['dataset'], res['uploaded'],
+                res['bytes'] / MEGABYTE, res['seconds'],
+                'done' if res['done'] else 'NOT DONE'))
+        total_files = sum(res['uploaded'] for res in results)
+        total_bytes = sum(res['bytes'] for res in results)
+        lines.append('Total: {} files, {:.1f} MB in {} ({:.2f} MB/s), {} errors'.format(
+            total_files, total_bytes / MEGABYTE, timedelta(seconds=int(seconds)),
+            total_bytes / MEGABYTE / seconds if seconds else 0.0,
+            sum(res['errors'] for res in results)))
+        self.events.emit('summary', '{text}', text='\n'.join(lines), batch=results,
+                         uploaded=total_files, bytes=total_bytes, seconds=seconds)
+
+
+    def _watch_targets(self, rows):
+        '''
+        The folders named in wildcard entries in the .csv file, each with
+        the file name patterns in it and the rows they came from.
+        '''
+        targets = {}
+        for row in rows:
+            if not row.src_file:
+                continue
+            if row.src_file[0] == '[':
+                if any(wild in row.src_file for wild in '*?'):
+                    self.events.emit('skipped', 'Not watching {files}, files uploaded as a '
+                                     'group are not watched', files=row.src_file)
+                continue
+            for entry in row.src_file.split(','):
+                folder, pattern = os.path.split(entry)
+                if not any(wild in pattern for wild in '*?'):
                     continue
-                expanded_files = self._make_file_list(src_file)
-                if expanded_files:
-                    self._upload_list(curr_data_dir, expanded_files, upload_prefix, dest_name)
-                    if self._stop_right_now:
-                        self._stop_right_now = False
-                        return False
-        print("Uploaded " + str(self._uploaded) + " files")
+                if any(wild in folder for wild in '*?') or not os.path.isdir(folder or '.'):
+                    continue
+                targets.setdefault(folder or '.', []).append((pattern, row))
+        return targets
+
+
+    def start_watch(self, poll=10):
+        '''
+        Start watching the folders with wildcard entries in the .csv file,
+        before the upload, so files that show up while it runs are not
+        taken for files that were already there. watch picks up from here.
+        Returns False if there is nothing to watch.
+        '''
+        targets = self._watch_targets(self._read_rows())
+        if not targets:
+            self.events.emit('error', 'There are no wildcard entries in {csv} to watch.',
+                             csv=self._csv_name)
+            return False
+        self._watching = (targets, DirWatcher(list(targets), poll))
         return True
 
+    def watch(self, quiet=30, poll=10):
+        '''
+        Keep watching the folders with wildcard entries in the .csv file, and
+        upload new files that match them as they show up, once nobody has
+        written to them for quiet seconds. They go where that row in the
+        .csv file says, and are renamed like any other upload. Runs until
+        the upload is stopped, or ^C on the command line. If start_watch
+        was called, files that showed up since then are uploaded too; ones
+        the upload already sent are found on the site and skipped.
+        '''
+        if self._watching is None and not self.start_watch(poll):
+            return False
+        targets, watcher = self._watching
+        self._watching = None
+        watcher.rescan()
+        self.events.emit('message', 'Watching {folders} folders ({polled} of them polled every '
+                         '{poll} seconds), stop to quit.', folders=len(targets),
+                         polled=len(watcher.polled), poll=poll)
+        last_save = time.time()
+        try:
+            while not self._cancel.cancelled:
+                watcher.wait(1.0)
+                if self.idle:
+                    self.idle()
+                for path in watcher.settled(quiet):
+                    name = os.path.basename(path)
+                    for pattern, row in targets.get(os.path.dirname(path) or '.', []):
+                        if not fnmatch.fnmatch(name, pattern):
+                            continue
+                        collection = self._resolve_dest(row.dest)
+                        if collection is None:
+                            self.events.emit('skipped', 'Cannot get to {dest}, skipping '
+                                             '{files}', dest=row.dest_name, files=path)
+                            continue
+                        self.progress.add(self._file_bytes([path]), 1)
+                        self._upload_list(collection, [[path]], row.prefix, self._show_dest(row))
+                if self._snap and time.time() - last_save > 60:
+                    self._save_snapshot()
+                    last_save = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        self._wait_for_pending()
+        self._save_snapshot()
+        self._cancel.reset()
+        return True
+
+
+    def _start_staging(self, files):
+        '''
+        Start copying files, in upload order, to the staging directory.
+        '''
+        if not self._stage_opts:
+            return
+        path, depth, max_gb = self._stage_opts
+        try:
+            self._stage = StagingCache(
+                path, depth, int(max_gb * 1024 * MEGABYTE),
+                report=lambda text: self.events.emit('error', '{text}', text=text))
+        except OSError as ex:
+            self.events.emit('error', 'Cannot stage files in {path}, error is {error}.',
+                             path=path, error=str(ex))
+            return
+        self.events.emit('message', 'Staging files in {path}, {depth} ahead, up to {gb} GB',
+                         path=path, depth=depth, gb=max_gb)
+        self._stage.plan(files)
+
+
+    def _stop_staging(self):
+        '''
+        Done with the staging directory for this run.
+        '''
+        if not self._stage:
+            return
+        self._stage.close()
+        self.events.emit('message', 'Staged {staged} files, reused {reused} staged copies, '
+                         'waited {stalled:.1f} seconds on the source', staged=self._stage.staged,
+                         reused=self._stage.reused, stalled=self._stage.stalled)
+        self._stage = None
+
+
+    def _run_summary(self):
+        '''
+        What we did, and how many trips to the server we saved doing it.
+        '''
+        fmt = ('Uploaded {uploaded} files\nSkipped {ready_saved} collection ready checks\n'
+               'Package cache saved {gets_saved} GETs')
+        if self._retries or self._errors:
+            fmt += '\n{retries} retries, {errors} errors'
+        if self._lister.pages:
+            fmt += '\nListed {paged} collections in {pages} pages'
+        if self._slow:
+            fmt += '\n{slow} packages took longer than expected to process'
+        self.events.emit('summary', fmt, uploaded=self._uploaded, bytes=self._sent_bytes,
+                         ready_saved=self._ready.saved, gets_saved=self._pkgs.saved,
+                         retries=self._retries, errors=self._errors,
+                         pages=self._lister.pages, paged=self._lister.paged,
+                         unpaged=self._lister.unpaged, slow=self._slow)
+
 
 def main():
     '''
@@ -841,12 +4683,110 @@ def main():
     Assumes you have python3 installed, the Blackfynn API installed, the
     Blackfynn Agent installed, and have a Blackfynn profile on the local machine
     that the Blackfynn API can access.
+    With no arguments, you are prompted for everything.
     '''
+    parser = argparse.ArgumentParser(
+        description='Upload the files listed in a .csv file to a Blackfynn dataset.')
+    parser.add_argument('csv', nargs='?',
+                        help='the .csv file, or .xlsx workbook, you are asked for one '
+                        'if not given')
+    parser.add_argument('--profile', help='the Blackfynn profile to use')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='save a snapshot of the dataset to speed up later runs, then exit')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='do not use the saved snapshot of the dataset')
+    parser.add_argument('--full', action='store_true',
+                        help='go through every row, not just the rows that are new or '
+                        'changed since the last run')
+    parser.add_argument('--check-only', action='store_true',
+                        help='check that the files in the .csv file(s) exist, without '
+                        'connecting to Blackfynn, then exit')
+    parser.add_argument('--audit', action='store_true',
+                        help='check that everything in the .csv file is on the site, then exit')
+    parser.add_argument('--checksums', action='store_true',
+                        help='with --audit, also compare checksums where the site has them')
+    parser.add_argument('--sync', action='store_true',
+                        help='only upload new and changed files and fix package names')
+    parser.add_argument('--delete-orphans', action='store_true',
+                        help='with --sync, delete packages that are not in the .csv file')
+    parser.add_argument('--log-events', metavar='FILE',
+                        help='also log what happens to FILE, one json object per line')
+    parser.add_argument('--stage', metavar='DIR',
+                        help='copy files to DIR on a local disk ahead of the uploads')
+    parser.add_argument('--stage-ahead', type=int, default=4, metavar='N',
+                        help='with --stage, how many files to copy ahead (default 4)')
+    parser.add_argument('--stage-gb', type=float, default=20, metavar='GB',
+                        help='with --stage, most space to use in DIR (default 20)')
+    parser.add_argument('--watch', action='store_true',
+                        help='after the upload, keep uploading new files that match '
+                        'wildcard entries in the .csv file as they show up')
+    parser.add_argument('--settle', type=float, default=30, metavar='SECONDS',
+                        help='with --watch, upload a new file once it has not changed '
+                        'for this long (default 30)')
+    parser.add_argument('--poll', type=float, default=10, metavar='SECONDS',
+                        help='with --watch, how often to look at folders on network '
+                        'drives (default 10)')
+    parser.add_argument('--batch', nargs='+', metavar='CSV',
+                        help='upload the files in several .csv files without asking '
+                        'anything, needs --profile')
+    parser.add_argument('--agent', action='store_true',
+                        help='with --batch, upload using the Blackfynn agent')
+    parser.add_argument('--no-add-ext', action='store_true',
+                        help='with --batch, do not add file extensions to package names')
+    parser.add_argument('--bandwidth', metavar='SPEC',
+                        help='with --batch, the bandwidth limit in MB/s, e.g. 20:00-07:00=0,*=10')
+    args = parser.parse_args()
+    if args.batch and not args.profile and not args.check_only:
+        parser.error('--batch needs --profile')
+    if args.check_only and not (args.csv or args.batch):
+        parser.error('--check-only needs a .csv file')
+
     print(sys.version)
     cmd_bf = UploadBlackfynn()
     print(sys.argv[0], 'Version', cmd_bf.get_version())
+    cmd_bf.events.subscribe(ConsoleSink())
+    if args.log_events:
+        log = JsonlSink(args.log_events)
+        cmd_bf.events.subscribe(log)
+        atexit.register(log.close)   # main ends in sys.exit in many places
+    if args.csv:
+        if not os.path.exists(args.csv):
+            sys.exit('The file {} does not exist.'.format(args.csv))
+        cmd_bf.set_csv(args.csv)
+    if args.profile:
+        cmd_bf.set_profile(args.profile)
+    cmd_bf.set_use_snapshot(not args.no_snapshot)
+    cmd_bf.set_sync(args.sync, args.delete_orphans)
+    cmd_bf.set_full(args.full)
+    cmd_bf.set_staging(args.stage, max(1, args.stage_ahead), args.stage_gb)
+    if args.check_only:
+        sys.exit(0 if cmd_bf.check_only(args.batch or [args.csv]) else 1)
+    if args.batch:
+        missing = [name for name in args.batch if not os.path.exists(name)]
+        if missing:
+            sys.exit('The file(s) {} do not exist.'.format(', '.join(missing)))
+        is_ok, errtxt = cmd_bf.validate_profile()
+        if not is_ok:
+            sys.exit('Bad profile or error trying to connect to Blackfynn.\n' + errtxt)
+        cmd_bf.set_add_ext(not args.no_add_ext)
+        cmd_bf.set_use_agent(args.agent)
+        if args.bandwidth:
+            is_ok, errtxt = cmd_bf.set_bandwidth(args.bandwidth)
+            if not is_ok:
+                sys.exit(errtxt)
+        finished = cmd_bf.run_batch(args.batch)
+        print('\nDONE!')
+        sys.exit(0 if finished else 1)
+    if args.snapshot:
+        cmd_bf.connect()
+        sys.exit(0 if cmd_bf.take_snapshot() else 1)
+    if args.audit:
+        cmd_bf.connect()
+        sys.exit(0 if cmd_bf.audit(args.checksums) else 1)
     cmd_bf.setup()
-    cmd_bf.do_upload()
+    watching = args.watch and cmd_bf.start_watch(args.poll)
+    if cmd_bf.do_upload() and watching:
+        cmd_bf.watch(args.settle, args.poll)
     print('\nDONE!')
 
 
@@ -23,17 +23,33 @@ from tkinter import Radiobutton
 from tkinter import Checkbutton
 from tkinter import scrolledtext
 from tkinter import Label
+from tkinter import Entry
 from tkinter import IntVar
+from tkinter import StringVar
 from tkinter import PhotoImage
+from tkinter import Frame
+from tkinter import Canvas
 from tkinter import END, DISABLED, NORMAL, RIGHT, WORD
+from collections import deque
 import os
 import sys
+import time
+import queue
+import threading
 import upload_bfynn as bfc
 
 
 # this has to exactly match the text in the help string.
 BOLD1 = 'TEMPLATE-for-SPARC-list-of-files-to-upload.xlsx'
 
+# the dashboard, (counter, title) in the order shown
+DASHBOARD = (('now', 'Now MB/s'), ('average', 'Average MB/s'), ('active', 'Sending'),
+             ('queued', 'Queued'), ('processing', 'Processing'), ('retries', 'Retries'),
+             ('errors', 'Errors'))
+DASH_MS = 1000          # how often the dashboard is refreshed
+DASH_WINDOW = 10        # seconds of finished sends the Now rate is taken over
+SPARK_POINTS = 60       # seconds of throughput in the sparkline
+
 HELP_TEXT = (
     '\nThis program uploads files to a Blackfynn SPARC dataset.\n\n',
     'It uses the structure and names in a .csv file to:\n\n',
@@ -43,7 +59,9 @@ HELP_TEXT = (
     '4. Renames the datapackages to conform to the SPARC BIDS-based naming conventions.\n\n',
     'It does not make any changes to your directories or files.\n\n',
     'See: TEMPLATE-for-SPARC-list-of-files-to-upload.xlsx for how to create the csv file.\n\n',
-    'Click on the Select CSV File button to pick a csv file.\n\n',
+    'Click on the Select CSV File button to pick a csv file.\n',
+    'You can also pick the .xlsx workbook itself, without saving it as a .csv\n',
+    'file. The sheet that was showing when it was saved is used.\n\n',
     'Select the Blackfynn profile you want to use. These are your log-in credentials.\n\n',
     'When uploading a known file type, Blackfynn removes the file extension.\n',
     'For example, if you upload "myfile.txt", the dataset will be\n',
@@ -59,7 +77,30 @@ HELP_TEXT = (
     'If you are uploading very large files that take more than an hour\n',
     'to upload, check the Use Blackfynn Agent. Otherwise, leave it unchecked.\n',
     'It takes a bit longer to use the Agent and, of course, it has to be installed.\n\n',
-    'Stopping an upload only takes effect after the current file upload has completed.\n\n',
+    'If you check Sync: Only Upload Changes, the .csv file is compared with\n',
+    'the dataset first. Only new files are uploaded, files whose size has\n',
+    'changed are replaced, and datapackages that do not follow the naming\n',
+    'conventions are renamed. Nothing else is touched.\n\n',
+    'Rows of the .csv file that were uploaded before without errors, and\n',
+    'whose files have not changed since, are skipped. Check Redo Unchanged\n',
+    'Rows to go through all of them anyway, for example after deleting\n',
+    'files in a browser.\n\n',
+    'To keep from swamping a shared network link, enter a Bandwidth Schedule\n',
+    'in MB/s. For example, 10 limits uploads to 10 MB/s all day, and\n',
+    '20:00-07:00=0,*=10 is full speed (0 means no limit) from 8 PM to 7 AM\n',
+    'and 10 MB/s the rest of the time. Leave it empty for no limit.\n',
+    'The limit is applied by pausing between files.\n\n',
+    'Stop Upload takes effect within a second, even in the middle of a file.\n',
+    'A file that was being sent when you stopped keeps going in the background,\n',
+    'Start Upload stays off until it is done. Then run the upload again, files\n',
+    'already there are skipped.\n\n',
+    'After you select a .csv file, the files in it are checked. With a lot of\n',
+    'files on a network drive this can take a while. Stop Checking stops it,\n',
+    'and you can use the .csv file anyway.\n\n',
+    'The line above this text shows how the upload is going: the MB/s right\n',
+    'now and on average, files being sent and waiting to be sent, packages\n',
+    'Blackfynn is still processing, retries and errors. The graph is the MB/s\n',
+    'for the last minute, the number is its top.\n\n',
     'Problems? Save the text to a file and email it to dshuman@usf.edu.\n'
     )
 
@@ -83,9 +124,29 @@ class UploadBfynnWin:
         self._add_ext.set(1)
         self._use_agent = IntVar()
         self._use_agent.set(0)
+        self._sync = IntVar()
+        self._sync.set(0)
+        self._full = IntVar()
+        self._full.set(0)
+        self._bandwidth = StringVar()
+        self._bandwidth.set('')
+        self._limit_txt = StringVar()
+        self._limit_txt.set('No limit')
         self._ui_ctl = {}
+        self._from_threads = queue.Queue()  # text and events from background threads
+        self._progress_open = False
+        self._checking = None               # thread checking the files in the .csv file
+        self._check_cancel = bfc.CancelToken()
+        self._check_result = False
+        self._dash = {}                     # dashboard counter -> StringVar
+        self._dash_rates = deque([0.0] * SPARK_POINTS, maxlen=SPARK_POINTS)
+        self._dash_sent = deque()   # (time, bytes sent) over the last DASH_WINDOW seconds
         self._create_gui()
-        self._upl_bf.set_overwrite(self.overwrite)
+        self._upl_bf.events.subscribe(self.show_event)
+        self._upl_bf.set_limit_display(self._limit_txt.set)
+        self._upl_bf.set_idle(self.flush)
+        self._poll_threads()
+        self._refresh_dashboard()
 
 
     def _create_gui(self):
@@ -138,12 +199,34 @@ class UploadBfynnWin:
         ctl2 = Checkbutton(self._master, text='Use Blackfynn Agent', padx=5, pady=5,
                            variable=self._use_agent)
         self._ui_ctl['checks'].append(ctl2)
+        ctl3 = Checkbutton(self._master, text='Sync: Only Upload Changes', padx=5, pady=5,
+                           variable=self._sync)
+        self._ui_ctl['checks'].append(ctl3)
+        ctl4 = Checkbutton(self._master, text='Redo Unchanged Rows', padx=5, pady=5,
+                           variable=self._full)
+        self._ui_ctl['checks'].append(ctl4)
 
         num_check = 1
         for opt in self._ui_ctl['checks']:
             opt.grid(columnspan=2, row=num_check, column=2, sticky='W')
             num_check += 1
+        Label(self._master, text='Bandwidth Schedule:', justify=RIGHT).grid(column=4, row=1,
+                                                                             sticky='E')
+        self._ui_ctl['bandwidth'] = Entry(self._master, textvariable=self._bandwidth, width=20)
+        self._ui_ctl['bandwidth'].grid(row=1, column=5, columnspan=2, sticky='W')
+        Label(self._master, text='Active Limit:', justify=RIGHT).grid(column=4, row=2, sticky='E')
+        Label(self._master, textvariable=self._limit_txt).grid(column=5, row=2, sticky='W')
         chatter_row = max(num_radio, num_check)
+        dash = Frame(self._master)
+        for col, (name, title) in enumerate(DASHBOARD):
+            self._dash[name] = StringVar()
+            self._dash[name].set('0')
+            Label(dash, text=title).grid(row=0, column=col, padx=8)
+            Label(dash, textvariable=self._dash[name]).grid(row=1, column=col, padx=8)
+        self._ui_ctl['sparkline'] = Canvas(dash, width=240, height=36, background='white')
+        self._ui_ctl['sparkline'].grid(row=0, column=len(DASHBOARD), rowspan=2, padx=8)
+        dash.grid(row=chatter_row, column=0, columnspan=8, sticky='W', padx=10)
+        chatter_row += 1
         self._ui_ctl['chatterbox'].grid(row=chatter_row, column=0, columnspan=8,
                                         sticky='NSEW', padx=10, pady=10)
         self._ui_ctl['chatterbox'].bind('<Key>', lambda _: 'break') # set r/o
@@ -166,30 +249,68 @@ class UploadBfynnWin:
         currdir = os.getcwd()
         csv_name = fdlg.askopenfilename(initialdir=currdir,
                                         title="Select file",
-                                        filetypes=(('csv files', '*.csv'),))
+                                        filetypes=(('csv files', '*.csv'),
+                                                   ('excel files', '*.xlsx')))
         if csv_name:
             self._ui_ctl['chatterbox'].insert(END, 'Selected ' + csv_name+'\n')
-            good_csv = True
             self._upl_bf.set_csv(csv_name)
             self._dset_name = self._upl_bf.curr_dataset()
             if not self._dset_name:
                 mbox.showerror('DATASET NAME ERROR',
                                'There is not a dataset name in the .csv file,'
                                'cannot upload.')
-                good_csv = False
-            if good_csv:
-                got_files = self._upl_bf.chk_files_exist()
-                if not got_files:
-                    if not mbox.askyesno('MISSING PATHS OR FILES', 'Some files are missing.\n'
-                                         'Do you want to continue anyway?'):
-                        good_csv = False
-            if good_csv:
-                self.write('\nUsing Dataset ' + self._dset_name + '\n')
-                self._ui_ctl['start'].config(state=NORMAL)
-                self._ui_ctl['stop'].config(state=DISABLED)
-            else:
                 self._ui_ctl['start'].config(state=DISABLED)
                 self._ui_ctl['stop'].config(state=DISABLED)
+                return
+            self._start_check()
+
+
+    def _start_check(self):
+        """
+        Check that the files in the .csv file exist in the background, there
+        can be thousands of them on a slow network drive. Stop stops it.
+        """
+        self._check_cancel.reset()
+        self._check_result = False
+        self._ui_ctl['start'].config(state=DISABLED)
+        self._ui_ctl['sel'].config(state=DISABLED)
+        self._ui_ctl['stop'].config(state=NORMAL, text='Stop Checking')
+        self._checking = threading.Thread(target=self._check_files, daemon=True)
+        self._checking.start()
+        self._master.after(100, self._check_done)
+
+
+    def _check_files(self):
+        """
+        Runs in the background thread.
+        """
+        self._check_result = self._upl_bf.chk_files_exist(self._check_cancel)
+
+
+    def _check_done(self):
+        """
+        Wait for the file check, then let the user upload if the files are
+        there, or if they want to go ahead anyway.
+        """
+        if self._checking.is_alive():
+            self._master.after(100, self._check_done)
+            return
+        self._checking = None
+        self._show_from_threads()
+        self._ui_ctl['stop'].config(state=DISABLED, text='Stop Upload')
+        self._ui_ctl['sel'].config(state=NORMAL)
+        good_csv = True
+        if self._check_cancel.cancelled:
+            good_csv = mbox.askyesno('FILE CHECK STOPPED', 'Not all of the files were checked.\n'
+                                     'Do you want to continue anyway?')
+        elif not self._check_result:
+            good_csv = mbox.askyesno('MISSING PATHS OR FILES', 'Some files are missing.\n'
+                                     'Do you want to continue anyway?')
+        if good_csv:
+            self.write('\nUsing Dataset ' + self._dset_name + '\n')
+            self._start_when_idle()
+        else:
+            self._ui_ctl['start'].config(state=DISABLED)
 
 
     def _clear(self):
@@ -207,16 +328,29 @@ class UploadBfynnWin:
         self._upl_bf.set_profile(self._profile)
         self._upl_bf.set_add_ext(self._add_ext.get())
         self._upl_bf.set_use_agent(self._use_agent.get())
-        is_ok, errmsg = self._upl_bf.validate_profile()
+        self._upl_bf.set_sync(self._sync.get())
+        self._upl_bf.set_full(self._full.get())
+        is_ok, errmsg = self._upl_bf.set_bandwidth(self._bandwidth.get())
+        if not is_ok:
+            mbox.showerror('BANDWIDTH SCHEDULE ERROR', errmsg)
+            return
+        self._limit_txt.set(self._upl_bf.curr_limit())
+        self.write('Trying to connect to dataset ' + self._dset_name + '. . .\n', flush=True)
+        self._ui_ctl['start'].config(state=DISABLED)
+        self._ui_ctl['sel'].config(state=DISABLED)
+        # the files were checked in the background when the .csv file was
+        # selected, and the user already said whether to go ahead
+        ready = self._upl_bf.preflight(check_files=False)
+        self._ui_ctl['start'].config(state=NORMAL)
+        self._ui_ctl['sel'].config(state=NORMAL)
+        is_ok, errmsg = ready['profile']
         if not is_ok:
             errtxt = ('Bad profile or error trying to connect to '
                       'Blackfynn, uploading aborted. ' + errmsg)
             mbox.showerror('PROFILE ERROR', errtxt)
             self.write(errtxt)
             return
-        self.write('Profile appears to be good.\n', flush=True)
-        self.write('Trying to connect to dataset ' + self._dset_name + '. . .')
-        is_ok, errmsg = self._upl_bf.bf_connect()
+        is_ok, errmsg = ready['dataset']
         if not is_ok:
             errtxt = 'Unable to connect to the dataset, uploading aborted. ' + '\n' + errmsg
             self.write('\n' + errtxt)
@@ -230,31 +364,49 @@ class UploadBfynnWin:
         self._ui_ctl['clear'].config(state=DISABLED)
         self._ui_ctl['help'].config(state=DISABLED)
         self._ui_ctl['save'].config(state=DISABLED)
+        self._ui_ctl['bandwidth'].config(state=DISABLED)
         if self._upl_bf.do_upload():
             self.write('Upload complete.\n')
         else:
             self.write('Upload cancelled.\n', flush=True)
         self._ui_ctl['sel'].config(state=NORMAL)
-        self._ui_ctl['start'].config(state=NORMAL)
+        self._start_when_idle()
         self._ui_ctl['close'].config(state=NORMAL)
         self._ui_ctl['clear'].config(state=NORMAL)
         self._ui_ctl['help'].config(state=NORMAL)
         self._ui_ctl['save'].config(state=NORMAL)
+        self._ui_ctl['bandwidth'].config(state=NORMAL)
         self._ui_ctl['stop'].config(state=DISABLED)
 
 
     def _abort(self):
         """
-        Kill the upload in progress
+        Kill the upload in progress, or the file check
         """
+        if self._checking:
+            self._check_cancel.cancel()
+            return
         self._upl_bf.cancel_upload()
         self._ui_ctl['sel'].config(state=NORMAL)
-        self._ui_ctl['start'].config(state=NORMAL)
         self._ui_ctl['close'].config(state=NORMAL)
         self._ui_ctl['stop'].config(state=DISABLED)
         self._ui_ctl['clear'].config(state=NORMAL)
         self._ui_ctl['help'].config(state=NORMAL)
         self._ui_ctl['save'].config(state=NORMAL)
+        self._ui_ctl['bandwidth'].config(state=NORMAL)
+
+
+    def _start_when_idle(self):
+        """
+        An upload that was stopped in the middle of a file keeps sending it
+        in the background. Keep Start Upload off until it is done, so the
+        next run does not send the same file again.
+        """
+        if self._upl_bf.busy():
+            self._ui_ctl['start'].config(state=DISABLED)
+            self._master.after(500, self._start_when_idle)
+        else:
+            self._ui_ctl['start'].config(state=NORMAL)
 
 
     def _save(self):
@@ -306,9 +458,15 @@ class UploadBfynnWin:
         garbage chars, remove it. Also detect and ignore the cursor movement cmds.
         The text widget is remarkably difficult to turn into a terminal that
         things want because there is no overwrite mode, just add text mode and the
-        idea of where the 'end' is seems flexible. Use overwrite to overwrite
-        the last line.
+        idea of where the 'end' is seems flexible. Messages from the upload
+        bfynn object come as events to show_event, which can replace a line.
         """
+        if threading.current_thread() is not threading.main_thread():
+            # tkinter is not thread safe, let the main thread show it
+            self._from_threads.put(text)
+            return
+        self._show_from_threads()
+        self._end_progress()
         if text.find('\r') >= 0:
             text = text.replace('\r', '')
         if text and text[0] == '\033' and text[1] == '[':
@@ -318,22 +476,120 @@ class UploadBfynnWin:
         if flush:
             self.flush()
 
-    def overwrite(self, text):
+    def _show_from_threads(self):
         '''
-        This is a callback from the upload bfyn object to
-        erase the last line and overwrite it. Used mainly
-        when waiting for time to pass.
+        Show any text that background threads wrote.
         '''
-        self._ui_ctl['chatterbox'].delete('end-1c linestart', 'end')
-        self._ui_ctl['chatterbox'].insert(END, text)
-        self._ui_ctl['chatterbox'].see(END)
+        while True:
+            try:
+                item = self._from_threads.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, bfc.Event):
+                self.show_event(item)
+            else:
+                self.write(item)
+
+
+    def _poll_threads(self):
+        '''
+        Background threads may finish writing after the upload loop
+        is done, check for their text now and then.
+        '''
+        self._show_from_threads()
+        self._master.after(250, self._poll_threads)
+
+
+    def _refresh_dashboard(self):
+        '''
+        Update the dashboard from the upload object's counters, not from
+        the text it shows, and add the rate right now to the sparkline.
+        The rate right now is from the bytes in sends that finished in the
+        last DASH_WINDOW seconds, not from the estimate of the ones in flight.
+        The event loop runs while uploading, so this keeps going then.
+        '''
+        stat = self._upl_bf.counters()
+        now = time.time()
+        sent = self._dash_sent
+        if sent and stat['sent_bytes'] < sent[-1][1]:
+            sent.clear()    # a new run started
+        sent.append((now, stat['sent_bytes']))
+        while now - sent[0][0] > DASH_WINDOW:
+            sent.popleft()
+        then, sent_then = sent[0]
+        rate = (stat['sent_bytes'] - sent_then) / (now - then) if now > then else 0.0
+        self._dash_rates.append(rate)
+        self._dash['now'].set('{:.2f}'.format(rate / bfc.MEGABYTE))
+        self._dash['average'].set('{:.2f}'.format((stat['rate'] or 0) / bfc.MEGABYTE))
+        for name in ('active', 'queued', 'processing', 'retries', 'errors'):
+            self._dash[name].set(str(stat[name]))
+        self._draw_sparkline()
+        self._master.after(DASH_MS, self._refresh_dashboard)
+
+
+    def _draw_sparkline(self):
+        '''
+        The recent MB/s as a line, scaled to the highest one, which is
+        shown in the corner.
+        '''
+        canvas = self._ui_ctl['sparkline']
+        width = int(canvas.cget('width'))
+        height = int(canvas.cget('height'))
+        top = max(self._dash_rates) or 1.0
+        points = []
+        for num, rate in enumerate(self._dash_rates):
+            points += [num * (width - 1) / (SPARK_POINTS - 1),
+                       height - 2 - rate / top * (height - 4)]
+        canvas.delete('all')
+        canvas.create_line(*points, fill='blue')
+        canvas.create_text(2, 2, anchor='nw', font='helvetica 7',
+                           text='{:.1f}'.format(top / bfc.MEGABYTE))
+
+
+    def show_event(self, event):
+        '''
+        Events from the upload bfynn object land here. Progress lines,
+        like the time left in a bandwidth pause, replace each other
+        instead of piling up.
+        '''
+        if threading.current_thread() is not threading.main_thread():
+            self._from_threads.put(event)
+            return
+        text = event.text
+        if not text:
+            return
+        self._show_from_threads()
+        box = self._ui_ctl['chatterbox']
+        if event.kind in bfc.EventBus.PROGRESS:
+            if self._progress_open:
+                box.delete('progress', 'end-1c')
+            else:
+                box.mark_set('progress', 'end-1c')
+                box.mark_gravity('progress', 'left')
+                self._progress_open = True
+            box.insert(END, text)
+        else:
+            self._end_progress()
+            box.insert(END, text + '\n')
+        box.see(END)
         self.flush()
 
+    def _end_progress(self):
+        '''
+        The progress line is done, start a new line after it.
+        '''
+        if self._progress_open:
+            self._progress_open = False
+            self._ui_ctl['chatterbox'].insert(END, '\n')
+
 
     def flush(self):
         """
         Required for stdout redirect
         """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self._show_from_threads()
         self._master.update()   # run event loop
 
 